@@ -10,11 +10,11 @@ import re
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib
-import scipy as sc
 from tqdm import tqdm
 import csv
 from datetime import datetime
 from tkinter import Tk, filedialog
+import dsp
 import time as pytime
 import pint
 
@@ -57,7 +57,8 @@ def plot_arrays(arr_time, timeData, freq, psdData):
         x = arr_time
         y = timeData
 
-        popt, pcov = sc.optimize.curve_fit(damping_func, x, y)
+        # initial guess from FFT peak and envelope, fitted on a decimated subset
+        popt = dsp.fit_resonance(x, y, 1 / (x[1] - x[0]))['popt']
         [A, l, w, p] = popt
         zeta = l / np.sqrt(l ** 2 + w ** 2)
         delta = 2 * 3.1416 * zeta / np.sqrt(1 - zeta ** 2)
@@ -170,22 +171,14 @@ def find_peak(time_div, samplerate, freq_of_interest, range_width):
     if length > chunkSize:
         print("Transferring...", end=" ")
 
-    dataTemp = np.empty(chunkSize + 1)
-    w = np.empty(length)
-    i = 0
-    n = int(np.floor(length / chunkSize))
-    m = 0
-    numtrans = 0
+    timeData = np.empty(length, dtype=np.int16)
 
-    timeData = []
+    for start in tqdm(range(0, length, chunkSize)):
+        m = min(length, start + chunkSize)
+        yk.write("WAVEFORM:START {};:WAVEFORM:END {}".format(start, m - 1))
 
-    for i in tqdm(range(n + 1)):
-        m = min(length, (i + 1) * chunkSize) - 1
-        yk.write("WAVEFORM:START {};:WAVEFORM:END {}".format(i * chunkSize, m))
-
-        buff = yk.query_binary_values('WAVEFORM:SEND?', datatype='h', container=list)
-
-        timeData.extend(buff)
+        # decoded by numpy straight from the received block, no per-sample python ints
+        timeData[start:m] = yk.query_binary_values('WAVEFORM:SEND?', datatype='h', container=np.array)
 
     result = yk.query('WAVEFORM:OFFSET?')
     offset = extract_number(result)
@@ -194,15 +187,15 @@ def find_peak(time_div, samplerate, freq_of_interest, range_width):
     wRange = extract_number(result)
 
 
-    timeData = wRange * np.array(
-        timeData) * 10 / 24000 + offset  # some random bullshit formula in the communication manual
+    timeData = wRange * 10 / 24000 * timeData + offset  # some random bullshit formula in the communication manual
 
     timeData2 = 9.81 / 10 * timeData / 100
     time = np.array(range(len(timeData2))) / samplingRate
 
-    freq, psdAcc = sc.signal.periodogram(timeData2,
-                                         fs=samplingRate
-                                         )
+    # one boxcar segment over the record: the periodogram, through the same PSD engine as the app
+    psd = dsp.welch(samplingRate, len(timeData2), window='boxcar', noverlap=0)
+    psd.update(timeData2)
+    freq, psdAcc = psd.result()
     freq = freq[1:-1]
     psdAcc = psdAcc[1:-1]
     psdPos = psdAcc / freq ** 2
@@ -0,0 +1,33 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# asyncio layer over blocking pyvisa resources. Every instrument gets one worker thread: its commands run in the
+# order they were issued, while different instruments (and the event loop) proceed concurrently.
+#   scope, generator = aio.instrument(yk), aio.instrument(ag)
+#   download = scope.call(read_waveform, yk, length, chunk_size)
+#   await asyncio.gather(generator.write('FREQuency 10'), download)
+
+
+class instrument:
+    def __init__(self, resource):
+        self.resource = resource
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='visa')
+
+    def call(self, function, *args, **kwargs):
+        # Any blocking sequence on the resource. It is queued right away, not when the result is awaited, so
+        # consecutive calls keep their order even when the first one is only awaited later.
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    def write(self, message):
+        return self.call(self.resource.write, message)
+
+    def close(self):
+        # waits for the queued commands, the resource itself stays open
+        self.executor.shutdown(wait=True)
+
+
+async def run(function, *args, **kwargs):
+    # A blocking sequence that opens its own resources (e.g. yk.acq.run) as one awaitable
+    return await asyncio.to_thread(function, *args, **kwargs)
@@ -0,0 +1,407 @@
+import time
+import numpy as np
+import scipy as sc
+
+# Signal processing engines that work chunk by chunk on records too long to process in one piece.
+
+
+class segments:
+    # Cuts a stream of chunks into overlapping windowed segments and transforms them in batches. Only the
+    # unfinished tail of the data (less than one segment) is kept between chunks, in a preallocated buffer.
+    def __init__(self, fs, nperseg, window='hann', noverlap=None, batch=64, workers=None):
+        self.fs = fs
+        self.nperseg = int(nperseg)
+        self.noverlap = self.nperseg // 2 if noverlap is None else int(noverlap)
+        if not 0 <= self.noverlap < self.nperseg:
+            raise ValueError('noverlap must be smaller than nperseg')
+        self.step = self.nperseg - self.noverlap
+        self.window = sc.signal.get_window(window, self.nperseg)
+        self.scale = 1 / (fs * np.sum(self.window ** 2))
+        self.batch = batch  # segments transformed at once
+        self.workers = workers  # threads per FFT batch, see scipy.fft
+        self.buffer = np.empty(self.nperseg)  # samples of the next segment received so far
+        self.filled = 0
+        self.segments = 0
+        self.samples = 0
+
+    def frequencies(self):
+        return np.fft.rfftfreq(self.nperseg, 1 / self.fs)
+
+    def spectra(self, chunk):
+        # Yields |FFT|^2 of the detrended, windowed segments completed by this chunk, batch by batch. Each sample
+        # is copied into the buffer at most once, so a segment as long as the record costs no more than a short one.
+        chunk = np.asarray(chunk, dtype=np.float64)
+        self.samples += len(chunk)
+        if self.filled + len(chunk) < self.nperseg:
+            self.buffer[self.filled:self.filled + len(chunk)] = chunk
+            self.filled += len(chunk)
+            return
+        skip = 0
+        if self.filled:
+            # Segments starting in the buffer, completed by the head of the chunk: less than two segments of data
+            joint = np.concatenate((self.buffer[:self.filled], chunk[:self.nperseg - 1]))
+            straddling = -(-self.filled // self.step)
+            count = min(straddling, (len(joint) - self.nperseg) // self.step + 1)
+            yield from self.transform(joint, count)
+            if count < straddling:
+                self.keep(joint[count * self.step:])
+                return
+            skip = straddling * self.step - self.filled
+        count = 0 if len(chunk) - skip < self.nperseg else (len(chunk) - skip - self.nperseg) // self.step + 1
+        yield from self.transform(chunk[skip:], count)
+        self.keep(chunk[skip + count * self.step:])
+
+    def transform(self, data, count):
+        # |FFT|^2 of the first count segments of data, batch by batch
+        for first in range(0, count, self.batch):
+            n = min(self.batch, count - first)
+            start = first * self.step
+            stop = start + (n - 1) * self.step + self.nperseg
+            segs = np.lib.stride_tricks.sliding_window_view(data[start:stop], self.nperseg)[::self.step]
+            segs = segs - segs.mean(axis=1, keepdims=True)
+            spectra = sc.fft.rfft(segs * self.window, axis=1, workers=self.workers)
+            yield spectra.real ** 2 + spectra.imag ** 2
+        self.segments += count
+
+    def keep(self, tail):
+        # start of the next segment, shorter than a segment
+        self.buffer[:len(tail)] = tail
+        self.filled = len(tail)
+
+    def density(self, power):
+        # One-sided power spectral density of a mean segment power
+        psd = power * self.scale
+        if self.nperseg % 2:
+            psd[..., 1:] *= 2
+        else:
+            psd[..., 1:-1] *= 2
+        return psd
+
+
+class welch(segments):
+    # Averaged periodogram (Welch) accumulated over chunks as they arrive. The result matches
+    # scipy.signal.welch with the same parameters and detrend='constant', scaling='density'.
+    def __init__(self, fs, nperseg, window='hann', noverlap=None, **kwargs):
+        super().__init__(fs, nperseg, window, noverlap, **kwargs)
+        self.sum = np.zeros(self.nperseg // 2 + 1)
+
+    def update(self, chunk):
+        for power in self.spectra(chunk):
+            self.sum += power.sum(axis=0)
+
+    def result(self):
+        # (frequencies, one-sided power spectral density) of the data so far
+        f = self.frequencies()
+        if self.segments == 0:
+            return f, np.full(len(f), np.nan)
+        return f, self.density(self.sum / self.segments)
+
+
+class stft(segments):
+    # Short-time power spectral density accumulated over chunks. With the expected record length given,
+    # consecutive frames are averaged so at most max_frames time bins are kept, whatever the record length.
+    def __init__(self, fs, nperseg, window='hann', noverlap=None, length=None, max_frames=1000, **kwargs):
+        super().__init__(fs, nperseg, window, noverlap, **kwargs)
+        frames = 0 if length is None or length < self.nperseg else (length - self.nperseg) // self.step + 1
+        self.average = max(1, -(-frames // max_frames))  # frames per time bin
+        self.rows = []
+        self.pending = np.zeros(self.nperseg // 2 + 1)
+        self.pending_count = 0
+
+    def update(self, chunk):
+        for power in self.spectra(chunk):
+            i = 0
+            while i < len(power):
+                take = min(self.average - self.pending_count, len(power) - i)
+                self.pending += power[i:i + take].sum(axis=0)
+                self.pending_count += take
+                i += take
+                if self.pending_count == self.average:
+                    self.rows.append(self.density(self.pending / self.average))
+                    self.pending = np.zeros_like(self.pending)
+                    self.pending_count = 0
+
+    def result(self):
+        # (frequencies, bin center times, PSD with shape (times, frequencies)) of the data so far
+        rows = list(self.rows)
+        if self.pending_count:
+            rows.append(self.density(self.pending / self.pending_count))
+        frames = np.arange(self.segments)
+        centers = (frames * self.step + self.nperseg / 2) / self.fs
+        starts = np.arange(0, self.segments, self.average)
+        counts = np.minimum(starts + self.average, self.segments) - starts
+        t = np.add.reduceat(centers, starts) / counts if rows else np.empty(0)
+        Sxx = np.array(rows) if rows else np.empty((0, self.nperseg // 2 + 1))
+        return self.frequencies(), t, Sxx
+
+
+# Decimation of traces for plotting: the number of output points is set by a pixel budget, independent
+# of the record length. Records are read span by span so memory-mapped arrays are never loaded whole.
+
+SPAN = int(1E6)  # samples read per step
+
+
+def bin_size(length, bins):
+    return max(1, -(-length // max(1, bins)))
+
+
+def mean_reduce(y, bins):
+    # Means of consecutive bins of equal size (the last one may be shorter)
+    k = bin_size(len(y), bins)
+    step = k * max(1, SPAN // k)
+    out = []
+    for start in range(0, len(y), step):
+        segment = np.asarray(y[start:start + step], dtype=np.float64)
+        full = len(segment) // k * k
+        out.append(segment[:full].reshape(-1, k).mean(axis=1))
+        if full < len(segment):
+            out.append(segment[full:].mean(keepdims=True))
+    return np.concatenate(out) if out else np.empty(0)
+
+
+def minmax_indices(y, bins):
+    # Indices of the minimum and maximum of every bin in sample order, so peaks and glitches survive
+    k = bin_size(len(y), bins)
+    step = k * max(1, SPAN // k)
+    out = []
+    for start in range(0, len(y), step):
+        segment = np.asarray(y[start:start + step])
+        full = len(segment) // k * k
+        offsets = start + np.arange(0, len(segment), k)
+        pairs = []
+        if full:
+            rows = segment[:full].reshape(-1, k)
+            pairs.append(np.stack((rows.argmin(axis=1), rows.argmax(axis=1)), axis=1))
+        if full < len(segment):
+            tail = segment[full:]
+            pairs.append(np.array([[tail.argmin(), tail.argmax()]]))
+        pairs = np.sort(np.concatenate(pairs), axis=1) + offsets[:, None]
+        out.append(pairs.ravel())
+    return np.unique(np.concatenate(out)) if out else np.empty(0, dtype=np.intp)
+
+
+def lttb_indices(x, y, points):
+    # Largest-Triangle-Three-Buckets: per bucket the sample spanning the largest triangle with the previous
+    # pick and the mean of the next bucket. x=None uses the sample index.
+    n = len(y)
+    if points >= n or points < 3:
+        return np.arange(n)
+
+    def xs(start, stop):
+        return np.arange(start, stop, dtype=np.float64) if x is None else np.asarray(x[start:stop], np.float64)
+
+    every = (n - 2) / (points - 2)
+    picks = np.empty(points, dtype=np.intp)
+    picks[0] = a = 0
+    ax, ay = xs(0, 1)[0], float(y[0])
+    for i in range(points - 2):
+        start, stop = int(i * every) + 1, int((i + 1) * every) + 1
+        next_start, next_stop = stop, min(int((i + 2) * every) + 1, n)
+        bx, by = xs(next_start, next_stop).mean(), np.mean(y[next_start:next_stop])
+        cx, cy = xs(start, stop), np.asarray(y[start:stop], np.float64)
+        area = np.abs((ax - bx) * (cy - ay) - (ax - cx) * (by - ay))
+        a = start + int(np.argmax(area))
+        picks[i + 1] = a
+        ax, ay = cx[a - start], cy[a - start]
+    picks[-1] = n - 1
+    return picks
+
+
+def reduce_columns(x, z, bins):
+    # Averages groups of columns of z (and the matching x) so at most `bins` columns remain
+    z = np.asarray(z)
+    n = z.shape[-1]
+    if n <= bins:
+        return np.asarray(x), z
+    k = bin_size(n, bins)
+    starts = np.arange(0, n, k)
+    counts = np.minimum(starts + k, n) - starts
+    return np.add.reduceat(np.asarray(x), starts) / counts, np.add.reduceat(z, starts, axis=-1) / counts
+
+
+def decimate(x, y, points, method='minmax'):
+    # (x, y) reduced to about `points` samples with 'mean', 'minmax' or 'lttb'; x=None means sample index
+    n = len(y)
+    if n <= points:
+        return (np.arange(n) if x is None else np.asarray(x)), np.asarray(y)
+    if method == 'mean':
+        bins = max(1, points)
+        if x is None:
+            starts = np.arange(0, n, bin_size(n, bins))
+            x_out = (starts + np.minimum(starts + bin_size(n, bins), n) - 1) / 2
+        else:
+            x_out = mean_reduce(x, bins)
+        return x_out, mean_reduce(y, bins)
+    if method == 'minmax':
+        picks = minmax_indices(y, max(1, points // 2))
+    elif method == 'lttb':
+        picks = lttb_indices(x, y, points)
+    else:
+        raise ValueError('Unknown decimation method: ' + str(method))
+    return (picks if x is None else np.asarray(x[picks])), np.asarray(y[picks])
+
+
+# Resonance (free decay) estimation: y = A exp(-l t) cos(w t - p)
+
+def damped_cosine(t, A, l, w, p):
+    return A * np.exp(-1 * l * t) * np.cos(w * t - p)
+
+
+def damped_cosine_jac(t, A, l, w, p):
+    decay = np.exp(-1 * l * t)
+    cos = np.cos(w * t - p)
+    sin = np.sin(w * t - p)
+    return np.stack((decay * cos, -t * A * decay * cos, -t * A * decay * sin, A * decay * sin), axis=1)
+
+
+def resonance_guess(t, y, fs):
+    # A, l, w, p from the FFT peak (parabolic interpolation) and the log of the Hilbert envelope.
+    # No window: a free decay already tapers itself, and a symmetric one would cut away its start.
+    y = np.asarray(y, dtype=np.float64)
+    y = y - y.mean()
+    spectrum = np.abs(np.fft.rfft(y))
+    k = int(np.argmax(spectrum[1:])) + 1
+    shift = 0.0
+    if k + 1 < len(spectrum):
+        a, b, c = np.log(spectrum[k - 1:k + 2] + 1E-300)
+        if a - 2 * b + c:
+            shift = 0.5 * (a - c) / (a - 2 * b + c)
+    w = 2 * np.pi * (k + shift) * fs / len(y)
+
+    analytic = sc.signal.hilbert(y)
+    envelope = np.abs(analytic)
+    # the envelope is only trusted away from the edges and above the noise
+    # (one period, at most a quarter of the record for guesses near w=0)
+    edge = max(1, int(fs / (w / (2 * np.pi)))) if w > 0 else 1
+    edge = min(edge, len(y) // 4)
+    inner = slice(edge, len(y) - edge)
+    keep = np.zeros(len(y), dtype=bool)
+    if len(y) - 2 * edge > 0:
+        keep[inner] = envelope[inner] > 0.05 * envelope[inner].max()
+    if keep.sum() > 2:
+        slope, intercept = np.polyfit(t[keep], np.log(envelope[keep]), 1)
+        l, A = max(0.0, -slope), np.exp(intercept)
+    else:
+        l, A = 0.0, envelope.max()
+
+    # analytic phase is w t - p, take the circular mean of w t - phase over the trusted part
+    phase = np.angle(analytic)
+    weights = envelope * keep if keep.any() else envelope
+    p = np.angle(np.sum(weights * np.exp(1j * (w * t - phase))))
+    return A, l, w, p
+
+
+def fit_resonance(t, y, fs, max_points=int(2E4), refine=False):
+    # Fits the damped cosine on a subset of at most max_points samples with an analytic Jacobian, starting from
+    # resonance_guess. The subset keeps the decay (about 5 time constants) and at least 8 samples per period.
+    # refine=True repeats the fit on all samples starting from the subset result.
+    timing = {}
+    tic = time.perf_counter()
+    n = len(y)
+    guess_n = min(n, 4 * max_points)
+    t_guess = np.asarray(t[:guess_n], dtype=np.float64)
+    p0 = resonance_guess(t_guess, y[:guess_n], fs)
+    timing['guess'] = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    A, l, w, p = p0
+    stop = n
+    if l > 0:
+        # t is uniformly sampled at fs: the index of t[0] + 5 / l without reading the time axis
+        stop = min(n, int(5 / l * fs) + 1)
+    stride = max(1, stop // max_points)
+    if w > 0:
+        stride = max(1, min(stride, int(fs * 2 * np.pi / w / 8)))
+    picks = slice(0, min(stop, stride * max_points), stride)
+    t_fit = np.asarray(t[picks], dtype=np.float64)
+    y_fit = np.asarray(y[picks], dtype=np.float64)
+    popt, pcov = sc.optimize.curve_fit(damped_cosine, t_fit, y_fit, p0=p0, jac=damped_cosine_jac)
+    timing['fit'] = time.perf_counter() - tic
+    points = len(t_fit)
+
+    if refine:
+        tic = time.perf_counter()
+        popt, pcov = sc.optimize.curve_fit(damped_cosine, np.asarray(t, dtype=np.float64),
+                                           np.asarray(y, dtype=np.float64), p0=popt, jac=damped_cosine_jac)
+        timing['refine'] = time.perf_counter() - tic
+        points = n
+
+    return {
+        'popt': popt,
+        'perr': np.sqrt(np.diag(pcov)),
+        'pcov': pcov,
+        'guess': np.array(p0),
+        'points': points,
+        'timing': timing,
+    }
+
+
+# Single-bin demodulation (digital lock-in) at known frequencies, O(N) without FFT temporaries
+
+LOCKIN_SPAN = 2 ** 16  # samples multiplied with the reference at once
+
+
+def window_span(window, start, stop, n):
+    # Samples [start, stop) of a symmetric window of length n, without building the whole window
+    k = np.arange(start, stop)
+    if window == 'boxcar':
+        return np.ones(len(k))
+    if window == 'hann':
+        return 0.5 - 0.5 * np.cos(2 * np.pi * k / max(1, n - 1))
+    raise ValueError('Unknown lock-in window: ' + str(window))
+
+
+def demodulate(y, fs, frequencies, window='hann'):
+    # Complex peak amplitudes of y at the given frequencies: abs() is the amplitude, angle() the phase of
+    # the cosine at the first sample. Works span by span, so memory does not grow with the record.
+    f = np.atleast_1d(np.asarray(frequencies, dtype=np.float64))
+    n = len(y)
+    acc = np.zeros(len(f), dtype=np.complex128)
+    weight = 0.0
+    for start in range(0, n, LOCKIN_SPAN):
+        stop = min(n, start + LOCKIN_SPAN)
+        w = window_span(window, start, stop, n)
+        reference = np.exp(-2j * np.pi * np.outer(f, np.arange(start, stop) / fs))
+        acc += reference @ (np.asarray(y[start:stop], dtype=np.float64) * w)
+        weight += w.sum()
+    if weight == 0:
+        return np.full(len(f), np.nan + 0j)
+    return 2 * acc / weight
+
+
+# Broadband excitation: one arbitrary-waveform period holding many tones on the harmonics of its repetition
+# frequency f0. Recording whole periods puts every tone exactly on an FFT bin, so one FFT of the record gives the
+# response at all of them (no leakage, no window).
+
+def multisine(harmonics, points, phases='schroeder', seed=None):
+    # One period of equal-amplitude tones at the given harmonic numbers, scaled to a peak of 1.
+    # 'schroeder' phases keep the crest factor low, 'random' gives periodic noise.
+    k = np.asarray(harmonics)
+    if phases == 'schroeder':
+        phi = -np.pi * np.arange(len(k)) * (np.arange(len(k)) + 1) / len(k)
+    elif phases == 'random':
+        phi = np.random.default_rng(seed).uniform(0, 2 * np.pi, len(k))
+    else:
+        raise ValueError('Unknown multisine phases: ' + str(phases))
+    spectrum = np.zeros(points // 2 + 1, dtype=np.complex128)
+    spectrum[k] = np.exp(1j * phi)
+    wave = np.fft.irfft(spectrum, n=points)
+    return wave / np.max(np.abs(wave))
+
+
+def chirp(h_start, h_stop, points):
+    # One period of a linear sweep from harmonic h_start to h_stop, peak of 1
+    x = np.arange(points) / points
+    return np.sin(2 * np.pi * (h_start * x + (h_stop - h_start) * x ** 2 / 2))
+
+
+def harmonic_amplitudes(y, fs, f0, harmonics):
+    # Complex peak amplitudes of y at harmonics * f0, from the largest whole number of periods in y.
+    # Same convention as demodulate: abs() is the amplitude, angle() the phase at the first sample.
+    samples = fs / f0  # per period
+    periods = int(len(y) // samples)
+    if periods < 1:
+        raise ValueError('Record shorter than one excitation period ({:g} s)'.format(1 / f0))
+    n = int(round(periods * samples))
+    spectrum = sc.fft.rfft(np.asarray(y[:n], dtype=np.float64))
+    return 2 * spectrum[np.asarray(harmonics) * periods] / n
@@ -0,0 +1,180 @@
+import io
+import numpy as np
+from datetime import datetime
+from yk import WORD_SCALE
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# Binary export of an acquisition: raw int16 counts with their scaling per channel, derived products
+# (PSD, fits, ...) as separate datasets. Layout, identical for HDF5 groups and NPZ key prefixes:
+#   C<n>/raw            int16 counts, volts = raw * range * WORD_SCALE + offset
+#   C<n>/<product>      derived arrays from channel_data
+#   C<n> attributes     range, offset, sampling_rate, length, amp_gain, word_scale
+
+# time-domain products that are just scaled copies of the raw counts and are not written again
+RAW_PRODUCTS = ('t', 't_volt', 't_acc')
+
+CHUNK = 2 ** 18  # samples per HDF5 chunk
+
+
+def default_format():
+    return 'hdf5' if h5py is not None else 'npz'
+
+
+def extension(fmt):
+    return {'hdf5': 'h5', 'npz': 'npz'}[fmt]
+
+
+def channel_attrs(meta, amp_gain=1):
+    return {
+        'range': meta['range'],
+        'offset': meta['offset'],
+        'sampling_rate': meta['sampling_rate'],
+        'length': meta['length'],
+        'amp_gain': amp_gain,
+        'word_scale': WORD_SCALE,
+    }
+
+
+def products(data):
+    # derived arrays of one channel worth writing next to the raw counts; the scaled copies are not even read,
+    # so lazily derived channels do not compute them
+    for key in (data or {}):
+        if key in RAW_PRODUCTS:
+            continue
+        value = data[key]
+        if value is None or np.size(value) == 0:
+            continue
+        yield key, np.asarray(value)
+
+
+def create_dataset(group, name, data, compression='gzip'):
+    # chunked and compressed along the sample axis so readers can slice without loading everything
+    data = np.asarray(data)
+    if data.size == 0:
+        return group.create_dataset(name, data=data)
+    chunks = (min(CHUNK, len(data)),) + data.shape[1:]
+    return group.create_dataset(name, data=data, chunks=chunks, compression=compression, shuffle=True)
+
+
+def write_hdf5(file, raw, meta, channel_data=None, amp_gain=1, compression='gzip'):
+    if h5py is None:
+        raise ImportError('h5py is required for HDF5 export, use fmt="npz" instead')
+    channel_data = channel_data or {}
+    with h5py.File(file, 'w') as f:
+        f.attrs['created'] = datetime.now().isoformat()
+        for channel, counts in raw.items():
+            group = f.create_group('C{}'.format(channel))
+            group.attrs.update(channel_attrs(meta[channel], amp_gain))
+            create_dataset(group, 'raw', counts, compression)
+            for key, value in products(channel_data.get(channel)):
+                create_dataset(group, key, value, compression)
+
+
+def write_npz(file, raw, meta, channel_data=None, amp_gain=1):
+    channel_data = channel_data or {}
+    arrays = {'created': np.array(datetime.now().isoformat())}
+    for channel, counts in raw.items():
+        prefix = 'C{}/'.format(channel)
+        arrays[prefix + 'raw'] = counts
+        for key, value in channel_attrs(meta[channel], amp_gain).items():
+            arrays[prefix + key] = np.array(value)
+        for key, value in products(channel_data.get(channel)):
+            arrays[prefix + key] = value
+    np.savez_compressed(file, **arrays)
+
+
+def save(file, raw, meta, channel_data=None, amp_gain=1, fmt=None):
+    # file is a path or a binary file object
+    fmt = fmt or default_format()
+    if fmt == 'hdf5':
+        write_hdf5(file, raw, meta, channel_data, amp_gain)
+    elif fmt == 'npz':
+        write_npz(file, raw, meta, channel_data, amp_gain)
+    else:
+        raise ValueError('Unknown export format: ' + str(fmt))
+
+
+def to_bytes(raw, meta, channel_data=None, amp_gain=1, fmt=None):
+    buffer = io.BytesIO()
+    save(buffer, raw, meta, channel_data, amp_gain, fmt)
+    return buffer.getvalue()
+
+
+def channel_columns(channel_data):
+    # ('C<n> <product>', array) for every 1-D product of every channel, in acquisition order
+    for channel, data in channel_data.items():
+        for key, value in (data or {}).items():
+            if np.ndim(value) > 1:
+                continue  # 2-D products (spectrogram) only go to the binary export
+            yield 'C{} {}'.format(channel, key), value
+
+
+def iter_csv(channel_data, fmt='%.12g', block_rows=65536):
+    # Yields the CSV of all channel products as byte chunks of at most block_rows rows.
+    # Columns may differ in length (time vs frequency domain): the record is split at every column end,
+    # so within a block the same columns are present in every row and a whole block is formatted at once.
+    headers, columns = [], []
+    for header, column in channel_columns(channel_data):
+        headers.append(header)
+        columns.append(column)
+    lengths = [len(column) for column in columns]
+    yield (','.join(headers) + '\r\n').encode()
+
+    rows = max(lengths, default=0)
+    bounds = sorted({0, rows} | {length for length in lengths if length < rows})
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        active = [column for column, length in zip(columns, lengths) if length >= hi]
+        row_fmt = ','.join(fmt if length >= hi else '' for length in lengths) + '\r\n'
+        for start in range(lo, hi, block_rows):
+            stop = min(hi, start + block_rows)
+            block = np.empty((stop - start, len(active)))
+            for i, column in enumerate(active):
+                block[:, i] = column[start:stop]
+            yield ((row_fmt * (stop - start)) % tuple(block.ravel().tolist())).encode()
+
+
+def write_csv(file, channel_data, **kwargs):
+    # file is a path or a binary file object
+    if hasattr(file, 'write'):
+        for chunk in iter_csv(channel_data, **kwargs):
+            file.write(chunk)
+        return
+    with open(file, 'wb') as f:
+        write_csv(f, channel_data, **kwargs)
+
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+
+def load(file):
+    # Opens an export: h5py.File (datasets slice from disk) or NpzFile (each member is decompressed whole on first
+    # access, there is no partial read of a compressed NPZ)
+    if hasattr(file, 'read'):
+        signature = file.read(len(HDF5_SIGNATURE))
+        file.seek(0)
+    else:
+        with open(file, 'rb') as f:
+            signature = f.read(len(HDF5_SIGNATURE))
+    if signature == HDF5_SIGNATURE:
+        if h5py is None:
+            raise ImportError('h5py is required to read HDF5 exports')
+        return h5py.File(file, 'r')
+    return np.load(file)
+
+
+def volts(store, channel, start=0, stop=None):
+    # Scaled samples [start, stop) of a channel. HDF5 reads only the chunks of that slice, NPZ decompresses all the
+    # raw counts of the channel and slices them afterwards
+    prefix = 'C{}'.format(channel)
+    if hasattr(store, 'attrs'):
+        group = store[prefix]
+        w_range, offset = group.attrs['range'], group.attrs['offset']
+        counts = group['raw'][start:stop]
+    else:
+        w_range, offset = float(store[prefix + '/range']), float(store[prefix + '/offset'])
+        counts = store[prefix + '/raw'][start:stop]
+    return counts * (w_range * WORD_SCALE) + offset
@@ -1,14 +1,31 @@
 import streamlit as st
 import yk
+import export
+import queue
 import threading
 from datetime import datetime
-import csv
-import io
 from stqdm import stqdm
 
 st.set_option('deprecation.showPyplotGlobalUse', False)
 
+
+
+@st.cache_resource
+def session_pool():
+    # one ResourceManager and one open session per instrument for the whole server process
+    return yk.session_pool()
+
+
+@st.cache_resource
+def analysis_cache():
+    # derived products of every record analysed by this server process, bounded LRU
+    return yk.analysis_cache()
+
+
 acq = yk.acq()
+acq.auto_chunk = True
+acq.rm = session_pool()
+acq.analysis = analysis_cache()
 
 if 'runFlag' not in st.session_state:
     st.session_state['runFlag'] = 0
@@ -20,46 +37,18 @@ if 'timestamp' not in st.session_state:
     st.session_state['timestamp'] = None
 if 'csv_bytes' not in st.session_state:
     st.session_state['csv_bytes'] = None
+if 'bin_bytes' not in st.session_state:
+    st.session_state['bin_bytes'] = None
+if 'raw' not in st.session_state:
+    st.session_state['raw'] = None  # (raw, meta) of the last acquisition, re-analysed without the instrument
+if 'analysed' not in st.session_state:
+    st.session_state['analysed'] = None  # (modes, gain) of channel_data
 
 
 # Create a title
 def get_csv_data(channel_data):
-    channel_keys = channel_data.keys()
-    key_sets = []
-    for key in channel_keys:
-        unique_keys = set()
-        data = channel_data[key]
-        unique_keys.update(data.keys())
-        key_sets.append(unique_keys)
-
-    headers = [f'C{channel} {item}' for channel, sets in zip(channel_keys, key_sets) for item in sets]
-
-    max_data_length = max(
-        [len(channel_data[channel][key]) for channel, sets in zip(channel_keys, key_sets) for key in sets])
-
-    csv_rows = [
-        [channel_data[channel][key][i] if i < len(channel_data[channel][key]) else ''
-         for channel, sets in zip(channel_keys, key_sets) for key in sets]
-        for i in stqdm(range(max_data_length))
-    ]
-
-    csv_string_io = io.StringIO()
-    csv_writer = csv.writer(csv_string_io)
-    csv_writer.writerow(headers)
-    csv_writer.writerows(csv_rows)
-
-    csv_string = csv_string_io.getvalue()
-    csv_string_io.close()
-
-    return csv_string
-
-
-@st.cache_resource
-def plot_figs(timestamp):
-    print('started plotting')
-    figs = st.session_state['figs']
-    print('stopped plotting')
-    return figs
+    # CSV formatted in numpy blocks, streamed chunk by chunk into one bytes object
+    return b''.join(stqdm(export.iter_csv(channel_data)))
 
 
 st.title('Yokogawa DL850E Acquisition GUI')
@@ -67,7 +56,7 @@ st.title('Yokogawa DL850E Acquisition GUI')
 # Create columns for dropdown
 dd_col1, dd_col2 = st.columns([1, 1])
 
-options = yk.get_devices()
+options = yk.get_devices(acq.rm)
 selected_option = dd_col1.selectbox('**Select a device:**', options)
 
 channels = range(1, 9)
@@ -75,7 +64,7 @@ selected_channels = dd_col2.multiselect('**Choose channels:**', channels)
 
 dd_col3, dd_col4 = st.columns([2, 1])
 
-modes = ['time domain', 'frequency domain', 'X vs Y', 'resonance']
+modes = ['time domain', 'frequency domain', 'spectrogram', 'X vs Y', 'resonance']
 selected_mode = dd_col3.multiselect('**Choose plot types:**', modes)
 
 gain = dd_col4.number_input('**Amplifier Gain:**',
@@ -83,8 +72,9 @@ gain = dd_col4.number_input('**Amplifier Gain:**',
                        value=1)
 
 # Create columns for buttons
-but_col1, but_col2 = st.columns([1, 10])
+but_col1, but_col2, but_col3 = st.columns([1, 3, 7])
 but_col2.empty()
+but_col3.empty()
 
 # Create a run button
 if but_col1.button('Run'):
@@ -92,6 +82,7 @@ if but_col1.button('Run'):
     st.session_state['runFlag'] = 0
     st.session_state['channel_data'] = None
     st.session_state['figs'] = None
+    st.session_state['bin_bytes'] = None
 
     progress_bar = st.empty()
 
@@ -100,20 +91,54 @@ if but_col1.button('Run'):
     acq.mode = selected_mode
     acq.amp_gain = gain
 
+    # The acquisition publishes throttled progress events; this thread sleeps on the queue in between
+    events = queue.Queue()
+    acq.progress = events
     acq_thread = threading.Thread(target=acq.run, args=(instr,))  # Pass instr as an argument
     acq_thread.start()  # Start the thread
-    while acq_thread.is_alive():
-        progress = acq.prog['prog']
-        prog_text = str(acq.prog['iteration']) + '/' + str(len(acq.channels))
-        progress_bar.progress(progress, text=prog_text)
+    error = None
+    while True:
+        try:
+            event = events.get(timeout=1)
+        except queue.Empty:
+            if not acq_thread.is_alive():
+                break
+            continue
+        if event['phase'] in ('done', 'error'):
+            error = event.get('error')
+            break
+        prog_text = '{}/{} {}'.format(min(event['iteration'], event['channels']), event['channels'], event['phase'])
+        if event['phase'] == 'transfer' and event['rate']:
+            prog_text += ' {:.1f} MB/s'.format(event['rate'] / 1E6)
+            if event['eta'] is not None:
+                prog_text += ', {:.0f} s left'.format(event['eta'])
+        progress_bar.progress(min(1.0, event['prog']), text=prog_text)
 
     acq_thread.join()
+    if error is not None:
+        progress_bar.empty()
+        st.error('Acquisition failed: ' + error)
+        st.stop()
+    st.session_state['raw'] = (acq.raw, acq.meta)
+    st.session_state['analysed'] = (tuple(selected_mode), gain)
     st.session_state['channel_data'] = acq.channel_data
     st.session_state['timestamp'] = datetime.now().strftime("%Y%m%d_%H%M%S")
     progress_bar.empty()
     print('finished data acquisition')
     st.session_state['runFlag'] = 1
 
+# Other plot types or gain for the record in hand: derive again from its raw counts, cached products are reused
+elif st.session_state['raw'] is not None and st.session_state['analysed'] != (tuple(selected_mode), gain):
+    print('re-analysing')
+    acq.raw, acq.meta = st.session_state['raw']
+    acq.channels = list(acq.raw)
+    acq.mode = selected_mode
+    acq.amp_gain = gain
+    st.session_state['channel_data'] = acq.analyse()
+    st.session_state['bin_bytes'] = None
+    st.session_state['analysed'] = (tuple(selected_mode), gain)
+    st.session_state['runFlag'] = 1
+
 # If the run button was pressed, plot the figure
 if st.session_state['runFlag'] == 1:
     print('getting plots')
@@ -124,19 +149,29 @@ if st.session_state['runFlag'] == 1:
 
 # Once plotting is done, save the plot to the session state, and display it, and show save button
 if st.session_state['runFlag'] >= 2:
-    figs = plot_figs(st.session_state['timestamp'])
+    figs = st.session_state['figs']
     for fig in figs:
         st.plotly_chart(fig)
     if st.session_state['runFlag'] == 2:
         print('started csv')
-        csv = get_csv_data(st.session_state['channel_data'])
-        csv_bytes = csv.encode('utf-8')
-        st.session_state['csv_bytes'] = csv_bytes
-        st.session_state['runFlag'] = 3
+        st.session_state['csv_bytes'] = get_csv_data(st.session_state['channel_data'])
         print('stopped csv')
+        st.session_state['runFlag'] = 3
     if st.session_state['runFlag'] == 3:
         but_col2.download_button("Download CSV",
                                  st.session_state['csv_bytes'],
                                  file_name=f"{st.session_state['timestamp']}_data.csv",
                                  key='download-csv'
                                  )
+        # The compressed binary export of all raw counts is only built when asked for
+        fmt = export.default_format()
+        if st.session_state['bin_bytes'] is None and but_col3.button('Prepare ' + fmt.upper(), key='prepare-bin'):
+            raw, meta = st.session_state['raw']
+            st.session_state['bin_bytes'] = export.to_bytes(raw, meta, st.session_state['channel_data'],
+                                                            amp_gain=st.session_state['analysed'][1], fmt=fmt)
+        if st.session_state['bin_bytes'] is not None:
+            but_col3.download_button("Download " + fmt.upper(),
+                                     st.session_state['bin_bytes'],
+                                     file_name=f"{st.session_state['timestamp']}_data.{export.extension(fmt)}",
+                                     key='download-bin'
+                                     )
@@ -0,0 +1,337 @@
+import re
+import copy
+import time
+import numpy as np
+from pyvisa import util
+
+# Simulated DL850E ScopeCorder and Agilent 33xxx generator speaking the subset of SCPI used by yk.py and tf.py.
+# Usage:
+#   acq.rm = sim.resource_manager(latency=0.01, bandwidth=4E6)
+#   acq.run(sim.YOKOGAWA)
+#   tf.rm, tf.time_scale = sim.resource_manager(time_scale=0.01), 0.01  # sweeps 100x faster than real time
+
+YOKOGAWA = 'SIM::YOKOGAWA::DL850E::INSTR'
+AGILENT = 'SIM::AGILENT::33220A::INSTR'
+
+# long form -> short form of every mnemonic we answer to
+MNEMONICS = {
+    'WAVEFORM': 'WAV', 'LENGTH': 'LENG', 'RECORD': 'REC', 'SRATE': 'SRAT', 'OFFSET': 'OFFS', 'RANGE': 'RANG',
+    'FORMAT': 'FORM', 'BYTEORDER': 'BYT', 'TRACE': 'TRAC', 'START': 'STAR', 'END': 'END', 'SEND': 'SEND',
+    'BITS': 'BITS', 'TRIGGER': 'TRIG', 'TIMEBASE': 'TIM', 'TDIV': 'TDIV', 'CALIBRATE': 'CAL', 'MODE': 'MODE',
+    'STOP': 'STOP', 'FREQUENCY': 'FREQ', 'OUTPUT': 'OUTP', 'VOLTAGE': 'VOLT', 'FUNCTION': 'FUNC',
+    'MINIMUM': 'MIN', 'MAXIMUM': 'MAX', 'COMMUNICATE': 'COMM', 'HEADER': 'HEAD', 'STATUS': 'STAT',
+    'CONDITION': 'COND', 'SINGLE': 'SING', 'ONSTART': 'ONST', 'USER': 'USER', 'DATA': 'DATA', 'VOLATILE': 'VOL',
+}
+SHORT = {**{v: v for v in MNEMONICS.values()}, **MNEMONICS}
+
+NOISE_BLOCK = 2 ** 16  # samples per noise seed of the simulated scope
+
+SI_PREFIX = {'p': 1E-12, 'n': 1E-9, 'u': 1E-6, 'm': 1E-3, 'k': 1E3, 'M': 1E6, 'G': 1E9}
+
+
+def normalize(header):
+    # ':WAVeform:LENGth?' -> 'WAV:LENG?'
+    query = header.endswith('?')
+    nodes = header.strip(':').rstrip('?').upper().split(':')
+    return ':'.join(SHORT.get(node, node) for node in nodes) + ('?' if query else '')
+
+
+def parse_value(string):
+    # '10k', '10kHz', '500ms', '1.0' -> float
+    match = re.match(r'\s*([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)\s*([pnumkMG]?)', string)
+    if not match:
+        raise ValueError('Invalid value: ' + string)
+    return float(match.group(1)) * SI_PREFIX.get(match.group(2), 1)
+
+
+class instrument:
+    def __init__(self, latency=0.0, bandwidth=None):
+        self.latency = latency  # seconds per write or read
+        self.bandwidth = bandwidth  # bytes/s of the link, None for unlimited
+        self.timeout = 2000
+        self.chunk_size = 20 * 1024
+        self.read_termination = '\n'
+        self.write_termination = '\n'
+        self.log = []
+        self.bytes_sent = 0
+        self._response = b''
+
+    def _wait(self, nbytes=0):
+        delay = self.latency
+        if self.bandwidth:
+            delay += nbytes / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+
+    def _handle(self, header, args):
+        if header == '*RST':
+            self.reset()
+            return None
+        if header == '*IDN?':
+            return self.idn
+        if header == '*OPC?':
+            return '1'
+        raise ValueError('Undefined header: ' + header)
+
+    def write(self, message):
+        self._wait(len(message))
+        responses = []
+        for command in message.strip().split(';'):
+            if not command.strip():
+                continue
+            header, _, args = command.strip().partition(' ')
+            self.log.append(command.strip())
+            response = self._handle(normalize(header), args.strip())
+            if response is not None:
+                responses.append(response if isinstance(response, bytes) else response.encode())
+        if responses:
+            self._response = b';'.join(responses) + self.read_termination.encode()
+        return len(message)
+
+    def read_raw(self, size=None):
+        response, self._response = self._response, b''
+        self._wait(len(response))
+        self.bytes_sent += len(response)
+        return response
+
+    def read(self):
+        return self.read_raw().decode().rstrip(self.read_termination)
+
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    def query_binary_values(self, message, datatype='f', is_big_endian=False, container=list, **kwargs):
+        self.write(message)
+        block = self.read_raw()
+        offset, data_length = util.parse_ieee_block_header(block)
+        return util.from_binary_block(block, offset, data_length, datatype, is_big_endian, container)
+
+    def close(self):
+        pass
+
+
+class generator(instrument):
+    idn = 'Agilent Technologies,33220A,SIM,2.02'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.reset()
+
+    def reset(self):
+        self.function = 'SIN'
+        self.frequency = 1E3
+        self.voltage = 0.1
+        self.offset = 0.0
+        self.output = False
+        self.volatile = None  # arbitrary waveform points in [-1, 1], one period
+        self.user = 'VOL'
+
+    def _handle(self, header, args):
+        if header == 'FUNC':
+            self.function = args.upper()[:3]
+        elif header == 'FREQ':
+            self.frequency = parse_value(args)
+        elif header == 'VOLT':
+            self.voltage = parse_value(args)
+        elif header == 'VOLT:OFFS':
+            self.offset = parse_value(args)
+        elif header == 'OUTP':
+            self.output = args.upper() in ('ON', '1')
+        elif header == 'DATA':
+            name, _, points = args.partition(',')
+            if normalize(name) != 'VOL':
+                raise ValueError('Only volatile memory can be written: ' + name)
+            self.volatile = np.array([float(v) for v in points.split(',')])
+        elif header == 'FUNC:USER':
+            self.user = normalize(args)
+        elif header == 'FREQ?':
+            return repr(self.frequency)
+        elif header == 'OUTP?':
+            return '1' if self.output else '0'
+        else:
+            return super()._handle(header, args)
+        return None
+
+    def signal(self, t):
+        # volts at the generator output at times t
+        if not self.output:
+            return np.full(len(t), self.offset)
+        if self.function == 'USE' and self.volatile is not None:
+            # the points are played once per period, each held for 1/(frequency * points)
+            index = np.floor(t * self.frequency * len(self.volatile)).astype(np.int64) % len(self.volatile)
+            return self.offset + self.voltage / 2 * self.volatile[index]
+        return self.offset + self.voltage / 2 * np.sin(2 * np.pi * self.frequency * t)
+
+
+class scope(instrument):
+    idn = 'YOKOGAWA,DL850E,SIM,F1.00'
+
+    def __init__(self, generator=None, tone=10.0, noise=1E-3, coupling=1.0, seed=0, time_scale=1.0,
+                 trigger_delay=None, **kwargs):
+        super().__init__(**kwargs)
+        self.generator = generator  # drives every channel when set, like the tf bench wiring
+        self.tone = tone  # Hz of the synthetic signal on each channel (scaled by channel number)
+        self.noise = noise  # volts rms
+        self.coupling = coupling  # volts seen per volt of generator output
+        self.seed = seed
+        self.time_scale = time_scale  # wall seconds per acquired second, below 1 to run captures faster than real time
+        self.trigger_delay = trigger_delay  # acquired seconds from :START to a trigger event, None if none comes
+        self.reset()
+
+    def reset(self):
+        self.tdiv = 1.0
+        self.srate = 1E4
+        self.trace = 1
+        self.ranges = {channel: 1.0 for channel in range(1, 17)}
+        self.offsets = {channel: 0.0 for channel in range(1, 17)}
+        self.start = 0
+        self.end = 0
+        self.running = False
+        self.started = 0.0
+        self.trigger_mode = 'AUTO'
+        self.drive = None  # generator state during the last acquisition, frozen at :START
+        self.byteorder = 'LSBFIRST'
+        self.format = 'WORD'
+
+    @property
+    def length(self):
+        return int(round(10 * self.tdiv * self.srate))
+
+    def is_running(self):
+        # bit 0 of the condition register: an on-start acquisition stops after one record, a single-shot one after
+        # one record from the trigger (never without one), the other modes run until :STOP
+        if not self.running or self.trigger_mode not in ('ONST', 'SING'):
+            return self.running
+        record = 10 * self.tdiv
+        if self.trigger_mode == 'SING':
+            if self.trigger_delay is None:
+                return True
+            record += self.trigger_delay
+        if time.perf_counter() - self.started >= record * self.time_scale:
+            self.running = False
+        return self.running
+
+    def waveform(self, start, stop, channel=None):
+        # synthetic volts of samples [start, stop) on a channel, reproducible for any slice
+        channel = self.trace if channel is None else channel
+        t = np.arange(start, stop) / self.srate
+        volts = self.offsets[channel] + 0.5 * self.ranges[channel] * np.sin(2 * np.pi * self.tone * channel * t)
+        if self.noise:
+            volts += self.noise_samples(start, stop, channel)
+        drive = self.drive if self.drive is not None else self.generator
+        if drive is not None:
+            volts += self.coupling * drive.signal(t)
+        return volts
+
+    def noise_samples(self, start, stop, channel):
+        # Gaussian noise seeded per fixed block of samples, so any chunking of a record reads the same samples
+        first, last = start // NOISE_BLOCK, -(-stop // NOISE_BLOCK)
+        noise = np.concatenate([np.random.default_rng((self.seed, channel, block)).normal(0, self.noise, NOISE_BLOCK)
+                                for block in range(first, last)] or [np.empty(0)])
+        return noise[start - first * NOISE_BLOCK:stop - first * NOISE_BLOCK]
+
+    def counts(self, start, stop, channel=None):
+        channel = self.trace if channel is None else channel
+        counts = (self.waveform(start, stop, channel) - self.offsets[channel]) * 2400 / self.ranges[channel]
+        return np.clip(np.round(counts), -32768, 32767).astype(np.int16)
+
+    def _block(self):
+        start = max(0, self.start)
+        stop = min(self.length, self.end + 1)
+        counts = self.counts(start, max(start, stop))
+        counts = counts.astype('>i2' if self.byteorder == 'MSBFIRST' else '<i2')
+        data = counts.tobytes()
+        size = str(len(data))
+        return b'#' + str(len(size)).encode() + size.encode() + data
+
+    def _handle(self, header, args):
+        if header == 'STAR':
+            self.running = True
+            self.started = time.perf_counter()
+            # the record is what the generator put out while acquiring, later retuning must not change it
+            self.drive = copy.copy(self.generator) if self.generator is not None else None
+        elif header == 'STOP':
+            self.running = False
+        elif header in ('CAL:MODE', 'COMM:HEAD'):
+            pass
+        elif header == 'TIM:TDIV':
+            self.tdiv = parse_value(args)
+        elif header == 'TIM:SRAT':
+            self.srate = parse_value(args)
+        elif header == 'WAV:TRAC':
+            self.trace = int(parse_value(args))
+        elif header in ('WAV:FORM', 'WAV:REC'):
+            pass
+        elif header == 'WAV:BYT':
+            self.byteorder = args.upper()
+        elif header == 'WAV:STAR':
+            self.start = int(parse_value(args))
+        elif header == 'WAV:END':
+            self.end = int(parse_value(args))
+        elif header == 'TRIG:MODE':
+            self.trigger_mode = normalize(args)
+        elif header == 'STAT:COND?':
+            return str(int(self.is_running()))
+        elif header == 'WAV:SEND?':
+            return self._block()
+        elif header == 'WAV:LENG?':
+            return str(self.length)
+        elif header in ('WAV:SRAT?', 'TIM:SRAT?'):
+            return '{:.6E}'.format(self.srate)
+        elif header == 'TIM:TDIV?':
+            return '{:.6E}'.format(self.tdiv)
+        elif header == 'WAV:REC?':
+            return '0'
+        elif header == 'WAV:RANG?':
+            return '{:.6E}'.format(self.ranges[self.trace])
+        elif header == 'WAV:OFFS?':
+            return '{:.6E}'.format(self.offsets[self.trace])
+        elif header == 'WAV:BITS?':
+            return '16'
+        elif header == 'WAV:TRIG?':
+            return '0'
+        elif header == 'WAV:TRAC?':
+            return str(self.trace)
+        elif header == 'WAV:FORM?':
+            return self.format
+        else:
+            return super()._handle(header, args)
+        return None
+
+
+class resource_manager:
+    # Stand-in for pyvisa.ResourceManager that hands out one simulated scope and generator
+    def __init__(self, latency=0.0, bandwidth=None, yokogawa=YOKOGAWA, agilent=AGILENT, **scope_kwargs):
+        self.generator = generator(latency=latency, bandwidth=bandwidth)
+        self.scope = scope(generator=self.generator, latency=latency, bandwidth=bandwidth, **scope_kwargs)
+        self.resources = {yokogawa: self.scope, agilent: self.generator}
+
+    def list_resources(self):
+        return tuple(self.resources)
+
+    def open_resource(self, name, **kwargs):
+        if name not in self.resources:
+            raise ValueError('Unknown resource: ' + name)
+        return self.resources[name]
+
+    def close(self):
+        pass
+
+
+if __name__ == '__main__':
+    # Throughput benchmark of yk.acq against a simulated USB-like link
+    import sys
+    import yk
+
+    points = int(float(sys.argv[1])) if len(sys.argv) > 1 else int(1E6)
+    acq = yk.acq()
+    acq.rm = resource_manager(latency=1E-3, bandwidth=4E7)
+    acq.rm.scope.srate = points / 10
+    acq.channels = [1, 2]
+    start = time.perf_counter()
+    acq.run(YOKOGAWA)
+    elapsed = time.perf_counter() - start
+    nbytes = acq.rm.scope.bytes_sent
+    print('{} points x {} channels in {:.3f} s, {:.2f} MB/s'.format(points, len(acq.channels), elapsed,
+                                                                    nbytes / elapsed / 1E6))
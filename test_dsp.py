@@ -0,0 +1,45 @@
+import numpy as np
+import scipy.signal
+import pytest
+import dsp
+
+
+def feed(engine, x, chunk):
+    for start in range(0, len(x), chunk):
+        engine.update(x[start:start + chunk])
+    return engine.result()
+
+
+@pytest.mark.parametrize('nperseg, noverlap, chunk', [(1024, 512, 1000), (4096, 1000, 37), (256, 0, 100000)])
+def test_welch_matches_scipy(nperseg, noverlap, chunk):
+    x = np.random.default_rng(0).normal(size=100000)
+    f, psd = feed(dsp.welch(1E3, nperseg, noverlap=noverlap), x, chunk)
+    f_ref, psd_ref = scipy.signal.welch(x, 1E3, nperseg=nperseg, noverlap=noverlap)
+    assert np.allclose(f, f_ref)
+    assert np.allclose(psd, psd_ref)
+
+
+def test_welch_single_segment_is_the_periodogram():
+    # one boxcar segment over the record, fed in chunks as tf and acq do
+    x = np.random.default_rng(1).normal(size=123457)
+    f, psd = feed(dsp.welch(1E4, len(x), window='boxcar', noverlap=0), x, int(1E4))
+    f_ref, psd_ref = scipy.signal.periodogram(x, 1E4)
+    assert np.allclose(f, f_ref)
+    assert np.allclose(psd, psd_ref)
+
+
+def test_stft_matches_scipy_spectrogram():
+    x = np.random.default_rng(2).normal(size=50000)
+    f, t, Sxx = feed(dsp.stft(1E3, 512, length=len(x), max_frames=10 ** 6), x, 3333)
+    f_ref, t_ref, Sxx_ref = scipy.signal.spectrogram(x, 1E3, window='hann', nperseg=512, noverlap=256)
+    assert np.allclose(f, f_ref)
+    assert np.allclose(t, t_ref)
+    assert np.allclose(Sxx, Sxx_ref.T)
+
+
+def test_stft_averages_down_to_max_frames():
+    x = np.random.default_rng(3).normal(size=50000)
+    f, t, Sxx = feed(dsp.stft(1E3, 512, length=len(x), max_frames=20), x, 5000)
+    _, _, Sxx_ref = scipy.signal.spectrogram(x, 1E3, window='hann', nperseg=512, noverlap=256)
+    assert len(t) <= 20
+    assert np.allclose(Sxx.mean(axis=0), Sxx_ref.T.mean(axis=0), rtol=0.05)
@@ -0,0 +1,54 @@
+import json
+import numpy as np
+import pytest
+import sim
+import tf
+
+
+def simulated_tf(**settings):
+    # sweeps at 100x real time against the simulated bench
+    bench = tf.tf()
+    bench.rm = sim.resource_manager(time_scale=0.01, noise=1E-3)
+    bench.time_scale = 0.01
+    bench.yokogawaAddress, bench.agilentAddress = sim.YOKOGAWA, sim.AGILENT
+    for key, value in settings.items():
+        setattr(bench, key, value)
+    bench.open_instruments()
+    bench.initialize_instruments(voltage='1.0', time_div='200ms')
+    return bench
+
+
+def read_run(run_file):
+    with open(run_file) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_measure_appends_every_frequency_to_the_run_file(tmp_path):
+    run_file = str(tmp_path / 'run.jsonl')
+    bench = simulated_tf()
+    results = bench.measure([5, 40], [2, 2], ['200ms', '200ms'], run_file=run_file)
+    rows = read_run(run_file)
+    assert [row['frequency'] for row in rows] == [5.0, 40.0]
+    assert [tuple(row['result']) for row in rows] == [tuple(float(r) for r in result) for result in results]
+    assert all(len(row['values']) == 2 for row in rows)
+    assert len(bench.captures) == 4
+    assert all(capture['record'] == pytest.approx(2.0) for capture in bench.captures)
+
+
+def test_measure_resumes_from_the_run_file(tmp_path):
+    run_file = str(tmp_path / 'run.jsonl')
+    first = simulated_tf().measure([5, 40], [2, 2], ['200ms', '200ms'], run_file=run_file)
+
+    bench = simulated_tf()
+    results = bench.measure([5, 40, 80], [2, 2, 1], ['200ms'] * 3, run_file=run_file, resume=True)
+    assert len(bench.captures) == 1  # only 80 Hz is measured again
+    assert np.allclose(results[:2], first)
+    assert [row['frequency'] for row in read_run(run_file)] == [5.0, 40.0, 80.0]
+
+
+def test_lockin_and_psd_see_the_drive():
+    # the simulated scope records the generator as a flat acceleration; the psd detector divides by f ** 2
+    psd = simulated_tf().measure([5, 40], [1, 1], ['200ms', '200ms'])
+    lockin = simulated_tf(detector='lockin').measure([5, 40], [1, 1], ['200ms', '200ms'])
+    assert psd[0][0] / psd[1][0] == pytest.approx(8 ** 2, rel=0.05)
+    assert lockin[0][0] == pytest.approx(lockin[1][0], rel=0.05)
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import sim
+import yk
+
+
+def simulated_acq(rm=None, **settings):
+    acq = yk.acq()
+    acq.rm = rm if rm is not None else sim.resource_manager()
+    acq.channels = [1, 2]
+    acq.chunkSize = 10000
+    acq.processes = 1  # no process pool in tests, starting workers costs seconds
+    for key, value in settings.items():
+        setattr(acq, key, value)
+    return acq
+
+
+def interrupt_after(scope, blocks):
+    # :WAVEFORM:SEND? fails after the given number of blocks, like an unplugged cable
+    send = scope._block
+    calls = []
+
+    def block():
+        calls.append(scope.start)
+        if len(calls) > blocks:
+            raise ConnectionError('link lost')
+        return send()
+
+    scope._block = block
+    return calls
+
+
+@pytest.mark.parametrize('pipelined', [True, False])
+def test_run_transfers_the_simulated_record(pipelined):
+    acq = simulated_acq(pipelined=pipelined)
+    acq.run(sim.YOKOGAWA)
+    scope = acq.rm.scope
+    for channel in acq.channels:
+        assert np.array_equal(acq.raw[channel], scope.counts(0, scope.length, channel))
+        assert acq.meta[channel]['length'] == scope.length
+
+
+def test_run_rejects_a_short_block():
+    rm = sim.resource_manager()
+    send = rm.scope._block
+    rm.scope._block = lambda: send()[:-2]  # drop the last sample of every block
+    with pytest.raises(ValueError):
+        simulated_acq(rm).run(sim.YOKOGAWA)
+
+
+def test_run_resumes_from_store_dir(tmp_path):
+    rm = sim.resource_manager()
+    interrupt_after(rm.scope, 4)
+    with pytest.raises(ConnectionError):
+        simulated_acq(rm, store_dir=str(tmp_path), run_name='run').run(sim.YOKOGAWA)
+
+    del rm.scope._block  # the link is back
+    calls = interrupt_after(rm.scope, 10 ** 6)
+    acq = simulated_acq(rm, store_dir=str(tmp_path), run_name='run')
+    acq.run(sim.YOKOGAWA)
+    blocks = rm.scope.length // acq.chunkSize
+    assert len(calls) == 2 * blocks - 4  # only what the interrupted run had not stored
+    assert isinstance(acq.raw[1], np.memmap)
+    for channel in acq.channels:
+        assert np.array_equal(acq.raw[channel], rm.scope.counts(0, rm.scope.length, channel))
+
+
+def test_products_are_reused_from_the_analysis_cache():
+    acq = simulated_acq(mode=['frequency domain'])
+    acq.run(sim.YOKOGAWA)
+    psd = acq.channel_data[1]['psd_acc']
+    acq.analyse()
+    assert acq.channel_data[1]['psd_acc'] is psd
@@ -1,16 +1,23 @@
 import pyvisa
 import re
 import numpy as np
-import scipy as sc
 from tqdm import tqdm
 import time
 import sys
 import pint
 import os
 import pandas as pd
+import json
+import asyncio
 from datetime import datetime
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 from tkinter import Tk
 from tkinter.filedialog import asksaveasfilename
+from yk import read_waveform, scale_raw, chunk_tuner, query_values
+import dsp
+import aio
 
 # Globals
 ureg = pint.UnitRegistry()
@@ -103,19 +110,71 @@ def save_data_to_csv(data):
         print(f"An error occurred while saving the file: {str(e)}")
 
 
+# Run file of a sweep: one JSON object per measured frequency, appended and synced as soon as it completes,
+# {"frequency": .., "iterations": .., "time_div": .., "result": [mean, std(, phase)], "values": [...]}
+# Lock-in values are stored as [real, imag] pairs. A torn last line from a crash is ignored on load.
+def load_run(path):
+    rows = {}
+    if not path or not os.path.exists(path):
+        return rows
+    with open(path) as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            rows[float(row['frequency'])] = row
+    return rows
+
+
+def append_run(path, row):
+    with open(path, 'a') as f:
+        f.write(json.dumps(row) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def encode_values(values):
+    return [[v.real, v.imag] if np.iscomplexobj(v) else float(v) for v in values]
+
+
 class tf:
     def __init__(self):
         self.channel = str(1)
         self.yokogawaAddress = 'USB0::0x0B21::0x003F::39314B373135373833::INSTR'
         self.agilentAddress = 'USB0::0x0957::0x0407::MY44026553::INSTR'
         self.chunkSize = int(1E5)
+        self.auto_chunk = False  # tune chunkSize on the link and remember it per resource
+        self.tuner = None
+        self.detector = 'psd'  # 'psd': periodogram peak near the drive frequency, 'lockin': demodulate at it
+        self.lockin_window = 'hann'
+        self.psd_seconds = None  # Welch segment length, None for a single segment over the record (periodogram)
+        self.psd_window = 'hann'
+        self.psd_overlap = 0.5
+        self.reference_channel = None  # scope channel recording the drive; the lock-in reports phase against it
+        self.capture_mode = 'poll'  # 'poll': single-shot record, wait on the status condition; 'sleep': fixed sleeps
+        self.trigger_mode = 'ONSTart'  # one record right after :START, without waiting for a trigger
+        self.poll_interval = 0.02
+        self.capture_timeout = 10  # seconds allowed beyond the record length
+        self.time_scale = 1.0  # wall seconds per acquired second, the simulator's time_scale for offline runs
+        self.captures = []  # per capture record length, wall time and dead time in seconds
+        self.workers = 2  # analysis threads overlapping the next capture, 0 to analyse each capture inline
+        self.max_pending = 4  # downloaded records allowed to wait for analysis
+        self.__pool = None
+        self.__pending = deque()
+        self.__results = {}
+        self.excited = None  # frequencies measured by the last measure_broadband, per requested frequency
+        self.__timebase = None
+        self.rm = None  # pyvisa.ResourceManager by default, sim.resource_manager for offline runs
 
     def open_instruments(self):
-        rm = pyvisa.ResourceManager()
+        rm = self.rm if self.rm is not None else pyvisa.ResourceManager()
         resources = rm.list_resources()
         print(resources)
         if self.yokogawaAddress in resources:
             self.yk = rm.open_resource(self.yokogawaAddress)
+            if self.auto_chunk:
+                self.tuner = chunk_tuner(self.yokogawaAddress, self.chunkSize)
         else:
             print('Failed to find Yokogawa!')
             sys.exit()
@@ -133,6 +192,9 @@ class tf:
         self.yk.write(':TIMebase:TDIV ' + '1s')
         self.yk.write(':TIMebase:SRATE ' + sample_rate)
         self.yk.write(':TIMebase:TDIV ' + time_div)
+        self.__timebase = (sample_rate, time_div)
+        if self.capture_mode == 'poll':
+            self.yk.write(':TRIGger:MODE ' + self.trigger_mode)
 
         result = self.yk.query('WAVEFORM:RECord? MINimum')
         min_record = int(extract_number(result))
@@ -148,6 +210,8 @@ class tf:
         self.ag.write('VOLTage ' + voltage)
         self.ag.write('VOLTage:OFFSet ' + offset)
         self.ag.write('FREQuency 1')
+        self.__voltage = voltage
+        self.__shape = shape
 
     def initialize_instruments(self, sample_rate='10kHz', time_div='2s', voltage='10.0', shape='SINusoid', offset='0.0'):
         self.__sample_rate = sample_rate
@@ -155,53 +219,104 @@ class tf:
         self.__initialize_agilent(voltage=voltage, shape=shape, offset=offset)
         self.__initialize_yokogawa(sample_rate=sample_rate, time_div=time_div)
 
-    def __find_peak(self, frequency_of_interest, time_div, bin_size=0.5):
-        # We change the TDIV to 1s to force a refresh and ensure we are getting the most current data
-        self.yk.write(':TIMebase:TDIV ' + '1s')
-        self.yk.write(':TIMebase:SRATE ' + self.__sample_rate)
-        self.yk.write(':TIMebase:TDIV ' + time_div)
-
-        # Waveform capture sequence
-        self.yk.write(':START')
-        if convert_to_seconds(time_div) < 0.5:
-            time.sleep(12 * convert_to_seconds(time_div))
+    def __set_timebase(self, time_div):
+        # Only writes the timebase when it differs from what the scope already has
+        if self.__timebase == (self.__sample_rate, time_div):
+            return
+        self.yk.write(':TIMebase:SRATE ' + self.__sample_rate + ';:TIMebase:TDIV ' + time_div)
+        self.__timebase = (self.__sample_rate, time_div)
+
+    def __capture(self, time_div):
+        record = 10 * convert_to_seconds(time_div)
+        wall = record * self.time_scale
+        tic = time.perf_counter()
+        if self.capture_mode == 'sleep':
+            # We change the TDIV to 1s to force a refresh and ensure we are getting the most current data
+            self.yk.write(':TIMebase:TDIV ' + '1s')
+            self.yk.write(':TIMebase:SRATE ' + self.__sample_rate)
+            self.yk.write(':TIMebase:TDIV ' + time_div)
+            self.__timebase = (self.__sample_rate, time_div)
+
+            # Waveform capture sequence
+            self.yk.write(':START')
+            if convert_to_seconds(time_div) < 0.5:
+                time.sleep(12 * convert_to_seconds(time_div) * self.time_scale)
+            else:
+                time.sleep(11 * convert_to_seconds(time_div) * self.time_scale)
+            self.yk.write(':STOP')
         else:
-            time.sleep(11 * convert_to_seconds(time_div))
-        self.yk.write(':STOP')
-
-        # Download data from scope, convert it to an acceleration signal
-        result = self.yk.query(':WAVeform:SRATe?')  # Get sampling rate
-        sampling_rate = extract_number(result)
-
-        result = self.yk.query('WAVEFORM:LENGth?')  # Get waveform length
-        waveform_length = int(extract_number(result))
-
-        n = int(np.floor(waveform_length / self.chunkSize))
-
-        bit_data = []
-
-        for i in range(n + 1):
-            m = min(waveform_length, (i + 1) * self.chunkSize) - 1
-            self.yk.write("WAVEFORM:START {};:WAVEFORM:END {}".format(i * self.chunkSize, m))
-            buff = self.yk.query_binary_values('WAVEFORM:SEND?', datatype='h', container=list)
-            bit_data.extend(buff)
-
-        result = self.yk.query('WAVEFORM:OFFSET?')
-        waveform_offset = extract_number(result)
-
-        result = self.yk.query(':WAVeform:RANGe?')
-        waveform_range = extract_number(result)
-
-        voltage_data = waveform_range * np.array(
-            bit_data) * 10 / 24000 + waveform_offset  # formula from the communication manual
-
-        acceleration_data = 9.81 / 10 * voltage_data / 100
-        time_data = np.array(range(len(acceleration_data))) / sampling_rate
-
-        # Calculate position power spectral density
-        freq, psd_acc = sc.signal.periodogram(acceleration_data,
-                                              fs=sampling_rate
-                                              )
+            # Single record (ONSTart acquires right at :START like the free-running sleep mode, SINGle waits for a
+            # trigger first): the scope stops by itself once it is complete (condition register bit 0 clears)
+            self.__set_timebase(time_div)
+            self.yk.write(':START')
+            time.sleep(wall)
+            deadline = time.perf_counter() + wall + self.capture_timeout
+            while query_values(self.yk, [':STATus:CONDition?'], int)[0] & 1:
+                if time.perf_counter() > deadline:
+                    self.yk.write(':STOP')
+                    raise TimeoutError('Capture did not complete within {:g} s'.format(
+                        2 * wall + self.capture_timeout))
+                time.sleep(self.poll_interval)
+        elapsed = time.perf_counter() - tic
+        self.captures.append({'record': record, 'elapsed': elapsed, 'dead': elapsed - wall})
+
+    def __acquire(self, time_div):
+        self.__capture(time_div)
+        return self.__download()
+
+    def __read_trace(self):
+        # Download data from scope (sampling rate, length and scaling in one round trip)
+        sampling_rate, waveform_length, waveform_offset, waveform_range = query_values(
+            self.yk, [':WAVeform:SRATe?', ':WAVeform:LENGth?', ':WAVeform:OFFSet?', ':WAVeform:RANGe?'],
+            float, int, float, float)
+
+        bit_data = read_waveform(self.yk, waveform_length, self.chunkSize, tuner=self.tuner)
+        return bit_data, sampling_rate, waveform_range, waveform_offset
+
+    def __download(self):
+        # The measured channel, and with the lock-in detector the recorded drive when there is a reference channel
+        bit_data, sampling_rate, waveform_range, waveform_offset = self.__read_trace()
+        reference = None
+        if self.detector == 'lockin' and self.reference_channel is not None:
+            self.yk.write(':WAVeform:TRACE ' + str(self.reference_channel))
+            reference = self.__read_trace()
+            self.yk.write(':WAVeform:TRACE ' + self.channel)
+        return bit_data, sampling_rate, waveform_range, waveform_offset, reference
+
+    @staticmethod
+    def __acceleration(bit_data, waveform_range, waveform_offset):
+        voltage_data = scale_raw(bit_data, waveform_range, waveform_offset)  # formula from the communication manual
+        return 9.81 / 10 * voltage_data / 100
+
+    def __new_psd(self, sampling_rate, length):
+        # Same segmenting as yk.acq: the peak height of a tone scales with the segment length, and shorter
+        # segments trade the resolution bin_size picks from for a lower variance
+        if self.psd_seconds is None:
+            return dsp.welch(sampling_rate, max(1, length), window='boxcar', noverlap=0)
+        nperseg = max(1, min(length, int(self.psd_seconds * sampling_rate)))
+        return dsp.welch(sampling_rate, nperseg, window=self.psd_window, noverlap=int(self.psd_overlap * nperseg))
+
+    def __find_peak(self, bit_data, sampling_rate, waveform_range, waveform_offset, reference,
+                    frequency_of_interest, bin_size=0.5):
+        if self.detector == 'lockin':
+            acceleration_data = self.__acceleration(bit_data, waveform_range, waveform_offset)
+            # acceleration amplitude at the drive frequency only, no spectrum of the whole record
+            response = dsp.demodulate(acceleration_data, sampling_rate, frequency_of_interest,
+                                      window=self.lockin_window)[0]
+            if reference is None:
+                return np.abs(response)
+            # The capture start is not synchronized with the generator, so the phase is only meaningful
+            # against the drive recorded in the same capture
+            ref_data, ref_rate, ref_range, ref_offset = reference
+            drive = dsp.demodulate(scale_raw(ref_data, ref_range, ref_offset), ref_rate, frequency_of_interest,
+                                   window=self.lockin_window)[0]
+            return np.abs(response) * np.exp(1j * np.angle(response / drive))
+
+        # Calculate position power spectral density, scaling the record chunk by chunk into the accumulator
+        psd = self.__new_psd(sampling_rate, len(bit_data))
+        for start in range(0, len(bit_data), self.chunkSize):
+            psd.update(self.__acceleration(bit_data[start:start + self.chunkSize], waveform_range, waveform_offset))
+        freq, psd_acc = psd.result()
         freq = freq[1:-1]
         psd_acc = psd_acc[1:-1]
         psd_pos = psd_acc / freq ** 2
@@ -214,35 +329,228 @@ class tf:
 
         return max_value
 
-    def __measurement_cycle(self, frequency, num_iterations, time_div, bin_size=1):
-        self.ag.write('FREQuency ' + str(frequency))
+    def __harmonics(self, bit_data, sampling_rate, waveform_range, waveform_offset, reference, f0, harmonics,
+                    drive, records):
+        # Per tone, the value __find_peak gives for a sine at the full drive voltage in a record of the given
+        # seconds, as measure() takes it at that frequency: the acceleration amplitude (lock-in) or the position
+        # PSD peak of a tone of amplitude a on a bin, a ** 2 * sum(w) ** 2 / (2 fs sum(w ** 2)) / f ** 2 for a
+        # segment window w (a ** 2 * N / (2 fs) / f ** 2 for the periodogram of N samples).
+        acceleration_data = self.__acceleration(bit_data, waveform_range, waveform_offset)
+        response = dsp.harmonic_amplitudes(acceleration_data, sampling_rate, f0, harmonics)
+        amplitude = np.abs(response / drive) * float(self.__voltage) / 2
+        if self.detector == 'lockin':
+            return amplitude
+        gains = {}
+        for record in set(records):
+            window = self.__new_psd(sampling_rate, round(record * sampling_rate)).window
+            gains[record] = np.sum(window) ** 2 / np.sum(window ** 2)
+        gain = np.array([gains[record] for record in records])
+        return amplitude ** 2 * gain / (2 * sampling_rate) / (harmonics * f0) ** 2
+
+    @contextmanager
+    def __analysis_pool(self):
+        # Analysis threads for the duration of a sweep; leaving waits for every submitted capture
+        if not self.workers:
+            yield
+            return
+        with ThreadPoolExecutor(self.workers) as pool:
+            self.__pool, self.__pending = pool, deque()
+            try:
+                yield
+            finally:
+                self.__pool = None
+
+    def __start(self, function, *args):
+        # Analysis of a capture runs on the pool while the next one is armed and acquiring (scipy FFTs release
+        # the GIL), inline without a pool
+        if self.__pool is None:
+            future = Future()
+            future.set_result(function(*args))
+            return future
+        future = self.__pool.submit(function, *args)
+        self.__pending.append(future)
+        return future
+
+    def __submit(self, function, *args):
+        # At most max_pending downloaded records wait for a worker
+        future = self.__start(function, *args)
+        while len(self.__pending) > self.max_pending:
+            self.__pending.popleft().result()
+        return future
+
+    async def __drain(self):
+        # The same limit on the event loop: waiting for a worker must not hold up the other instrument's commands
+        while len(self.__pending) > self.max_pending:
+            await asyncio.wrap_future(self.__pending.popleft())
+
+    async def __tune(self, generator, frequency):
+        await generator.write('OUTPut OFF')
+        await generator.write('FREQuency ' + str(frequency))
+        await generator.write('OUTPut ON')
+        await asyncio.sleep(0.1)
+
+    async def __analyse(self, download, futures, frequency, bin_size):
+        futures.append(self.__start(self.__find_peak, *await download, frequency, bin_size))
+        await self.__drain()
+
+    async def __sweep(self, todo, bin_size, run_file, cycles):
+        # The generator is retuned and settles while the scope still downloads the last capture of the previous
+        # frequency. Each download is queued on the scope before the next capture, so records are never mixed up.
+        scope, generator = aio.instrument(self.yk), aio.instrument(self.ag)
+        downloads = []
+        try:
+            for freq, it, t in tqdm(todo):
+                await asyncio.gather(self.__tune(generator, freq), *downloads)
+                self.__checkpoint(cycles, run_file)
+                futures, downloads = [], []
+                cycles.append((freq, it, t, futures))
+                for _ in range(it):
+                    await scope.call(self.__capture, t)
+                    downloads.append(asyncio.ensure_future(
+                        self.__analyse(scope.call(self.__download), futures, freq, bin_size)))
+            await asyncio.gather(*downloads)
+            await generator.write('OUTPut OFF')
+        finally:
+            # captures already taken are still downloaded and analysed when the sweep fails
+            await asyncio.gather(*downloads, return_exceptions=True)
+            scope.close()
+            generator.close()
+
+    def __summarize(self, measurement_values):
+        if np.iscomplexobj(measurement_values):
+            # lock-in against a reference channel: mean and std of the amplitude, circular mean of the phase
+            magnitudes = np.abs(measurement_values)
+            phase = np.angle(np.mean(np.exp(1j * np.angle(measurement_values))))
+            return np.mean(magnitudes), np.std(magnitudes), phase
+        return np.mean(measurement_values), np.std(measurement_values)
+
+    def __checkpoint(self, cycles, run_file):
+        # Appends the leading cycles whose captures are all analysed without error, in sweep order;
+        # returns the rest
+        while cycles and len(cycles[0][3]) == cycles[0][1] and \
+                all(future.done() and future.exception() is None for future in cycles[0][3]):
+            freq, it, t, futures = cycles.pop(0)
+            values = [future.result() for future in futures]
+            self.__results[freq] = self.__summarize(values)
+            if run_file:
+                append_run(run_file, {'frequency': float(freq), 'iterations': int(it), 'time_div': t,
+                                      'result': [float(r) for r in self.__results[freq]],
+                                      'values': encode_values(values)})
+        return cycles
+
+    def measure(self, frequencies, iterations, time_div, bin_size=1, run_file=None, resume=False):
+        # (mean, std) per frequency, (mean amplitude, std, phase) with the lock-in detector and a reference channel.
+        # With a run_file every completed frequency is appended to it right away; resume skips the frequencies
+        # already in it and takes their results from the file.
+        done = load_run(run_file) if resume else {}
+        self.__results = {freq: tuple(row['result']) for freq, row in done.items()}
+        if run_file and not resume and os.path.exists(run_file):
+            os.remove(run_file)
+        todo = [(float(freq), it, t) for freq, it, t in zip(frequencies, iterations, time_div)
+                if float(freq) not in self.__results]
+        cycles = []
+        try:
+            with self.__analysis_pool():
+                asyncio.run(self.__sweep(todo, bin_size, run_file, cycles))
+        finally:
+            # the pool has drained here, keep whatever finished before an error
+            cycles = self.__checkpoint(cycles, run_file)
+        for _, _, _, futures in cycles:
+            for future in futures:
+                future.result()  # raises the failed analysis
+        return [self.__results[float(freq)] for freq in frequencies]
+
+    def __load_excitation(self, wave, f0):
+        # One period of the arbitrary waveform into volatile memory, played f0 times per second
+        self.ag.write('DATA VOLATILE, ' + ','.join('{:.4f}'.format(v) for v in wave))
+        self.ag.write('FUNCtion:USER VOLATILE')
+        self.ag.write('FUNCtion USER')
+        self.ag.write('FREQuency ' + repr(f0))
+
+    def measure_broadband(self, frequencies, iterations, time_div, resolution=0.1, excitation='multisine',
+                          points=2 ** 14, min_drive=0.05):
+        # All frequencies excited at once with a periodic arbitrary waveform, one capture per iteration with the
+        # longest of the records (10 * time_div) asked for, which must hold at least one period, 1 / resolution.
+        # Frequencies are snapped to the harmonics of resolution (the repetition frequency). iterations and
+        # time_div are per frequency as for measure(): a frequency averages its first iterations captures.
+        # Returns (mean, std) per requested frequency in the units of measure() with the same detector and
+        # time_div, scaled to a sine at the full drive voltage (assumes a linear system). Harmonics where the
+        # waveform puts less than min_drive of its strongest tone are dropped and give (nan, nan). self.excited
+        # holds the frequency actually measured for each requested one, nan where dropped.
+        f0 = float(resolution)
+        requested = np.maximum(1, np.round(np.asarray(frequencies, dtype=np.float64) / f0).astype(int))
+        records = [10 * convert_to_seconds(t) for t in time_div]
+        capture = time_div[int(np.argmax(records))]
+        if max(records) < 1 / f0:
+            raise ValueError('Record of 10 x {} is shorter than one period of {:g} s'.format(capture, 1 / f0))
+        harmonics = np.unique(requested)
+        if 2 * harmonics[-1] >= points:
+            raise ValueError('{} points per period cannot hold {:g} Hz at {:g} Hz resolution'.format(
+                points, harmonics[-1] * f0, f0))
+        if excitation == 'multisine':
+            wave = dsp.multisine(harmonics, points)
+        elif excitation == 'noise':
+            wave = dsp.multisine(harmonics, points, phases='random')
+        elif excitation == 'chirp':
+            wave = dsp.chirp(harmonics[0], harmonics[-1], points)
+        else:
+            raise ValueError('Unknown excitation: ' + str(excitation))
+
+        # Drive amplitude of every tone in volts, from the waveform itself (the chirp is not flat)
+        drive = dsp.harmonic_amplitudes(wave, points, 1, harmonics) * float(self.__voltage) / 2
+        keep = np.abs(drive) >= min_drive * np.max(np.abs(drive))
+        harmonics, drive = harmonics[keep], drive[keep]
+        index = np.searchsorted(harmonics, requested)
+        found = (index < len(harmonics)) & (harmonics[np.minimum(index, len(harmonics) - 1)] == requested)
+        self.excited = np.where(found, requested * f0, np.nan)
+
+        # one tone per requested frequency that is excited, repeated harmonics are analysed once per request
+        measured = np.flatnonzero(found)
+        tones, tone_drive = requested[measured], drive[index[measured]]
+        tone_records = [records[i] for i in measured]
+        captures = max((iterations[i] for i in measured), default=0)
+
+        self.__load_excitation(wave, f0)
         self.ag.write('OUTPut ON')
         time.sleep(0.1)
-        measurement_values = [self.__find_peak(frequency, time_div, bin_size=bin_size) for _ in tqdm(range(num_iterations))]
+        with self.__analysis_pool():
+            futures = [self.__submit(self.__harmonics, *self.__acquire(capture), f0, tones, tone_drive,
+                                     tone_records)
+                       for _ in tqdm(range(captures))]
         self.ag.write('OUTPut OFF')
-        return np.mean(measurement_values), np.std(measurement_values)
+        self.ag.write('FUNCtion ' + self.__shape)
 
-    def measure(self, frequencies, iterations, time_div, bin_size=1):
-        results = []
-        for freq, it, t in tqdm(zip(frequencies, iterations, time_div)):
-            mean, std = self.__measurement_cycle(freq, it, t, bin_size=bin_size)
-            results.append((mean, std))
+        values = np.array([future.result() for future in futures]).reshape(captures, len(measured))
+        results = [(np.nan, np.nan)] * len(requested)
+        for column, i in enumerate(measured):
+            tone_values = values[:iterations[i], column]
+            results[i] = (np.mean(tone_values), np.std(tone_values))
         return results
 
     def close_instruments(self):
         self.ag.write('OUTPut OFF')
         self.yk.write(':STOP')
-
-
-frequency = np.logspace(0, 2, num=300)
-iterations = [2 if freq > 4 else 2 for freq in frequency]
-time_divisions = ['2s' if freq < 2 else '500ms' if freq < 10 else '200ms' for freq in frequency]
-
-tf = tf()
-tf.open_instruments()
-tf.initialize_instruments(voltage='1.0')
-transfer_data = tf.measure(frequency, iterations, time_divisions, bin_size=1)
-tf.close_instruments()
-means, stds = zip(*transfer_data)
-
-save_data_to_csv([frequency, means, stds])
\ No newline at end of file
+        if self.tuner is not None:
+            self.chunkSize = self.tuner.best()
+            self.tuner.save()
+
+
+if __name__ == '__main__':
+    frequency = np.logspace(0, 2, num=300)
+    iterations = [2 if freq > 4 else 2 for freq in frequency]
+    time_divisions = ['2s' if freq < 2 else '500ms' if freq < 10 else '200ms' for freq in frequency]
+
+    # pass the run file of an interrupted sweep to measure only the remaining frequencies
+    run_file = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        os.getcwd(), 'temp', datetime.now().strftime('%Y%m%d%H%M') + '_transfer_run.jsonl')
+    os.makedirs(os.path.dirname(run_file), exist_ok=True)
+    print(f"Sweep progress is saved to: {run_file}")
+
+    tf = tf()
+    tf.open_instruments()
+    tf.initialize_instruments(voltage='1.0')
+    transfer_data = tf.measure(frequency, iterations, time_divisions, bin_size=1, run_file=run_file, resume=True)
+    tf.close_instruments()
+    columns = zip(*transfer_data)
+
+    save_data_to_csv([frequency, *columns])
\ No newline at end of file
@@ -1,145 +1,1031 @@
 import pyvisa
-import re
+import os
+import json
+import time
+import queue
+import threading
+import hashlib
+import weakref
+import multiprocessing
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from datetime import datetime
 import numpy as np
 import math
 import plotly.graph_objects as go
-import scipy as sc
 from tqdm import tqdm
+import dsp
+import aio
 
-def extract_number(string):
-    pattern = r'[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?'
-    match = re.search(pattern, string)
-    if match:
-        number_str = match.group()
+def parse_response(string, *types):
+    # Typed values of a (compound) query response, with or without headers:
+    # ':WAVEFORM:LENGTH 100000;:WAVEFORM:SRATE 1.0E+04' or '100000;1.0E+04' -> [100000, 10000.0]
+    fields = string.strip().split(';')
+    if len(fields) != len(types):
+        raise ValueError('Expected {} values, got: {}'.format(len(types), string.strip()))
+    values = []
+    for field, typ in zip(fields, types):
+        token = field.strip().rsplit(' ', 1)[-1]
+        values.append(int(float(token)) if typ is int else typ(token))
+    return values
+
+
+def query_values(yk, commands, *types):
+    # Sends the commands as one compound message and parses one value per query in it
+    return parse_response(yk.query(';'.join(commands)), *types)
+
+
+# volts per count at range 1, offset 0 for WORD format (from the communication manual)
+WORD_SCALE = 10 / 24000
+
+
+def read_block(yk, start, stop):
+    # Request samples [start, stop) and decode the binary block straight into a numpy view. A short or long reply
+    # is an error: the caller writes the block into a preallocated record that would keep unwritten samples.
+    yk.write(':WAVEFORM:START {};:WAVEFORM:END {}'.format(start, stop - 1))
+    block = yk.query_binary_values(':WAVEFORM:SEND?', datatype='h', container=np.array)
+    if len(block) != stop - start:
+        raise ValueError('Expected {} samples from {}, got {}'.format(stop - start, start, len(block)))
+    return block
+
+
+# points per :WAVEFORM:SEND? block the tuner may choose from
+CHUNK_LIMITS = (int(1E3), int(5E6))
+CHUNK_CACHE = os.path.join(os.path.expanduser('~'), '.yk_chunk_sizes.json')
+
+
+class chunk_tuner:
+    # Times the first blocks of a transfer and hill-climbs the chunk size toward the best bytes/s.
+    # The winner is remembered per resource string so the next run starts there.
+    def __init__(self, resource, size=int(1E5), trials=6, limits=CHUNK_LIMITS, cache=CHUNK_CACHE):
+        self.resource = resource
+        self.cache = cache
+        self.limits = limits
+        self.trials = trials
+        self.rates = {}
+        self.size = self.clip(self.load().get(resource, size))
+
+    def clip(self, size):
+        return int(min(max(size, self.limits[0]), self.limits[1]))
+
+    def load(self):
         try:
-            number = float(number_str)
-            return number
-        except ValueError:
-            pass
-    return None
+            with open(self.cache) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        sizes = self.load()
+        sizes[self.resource] = self.best()
+        try:
+            with open(self.cache, 'w') as f:
+                json.dump(sizes, f, indent=1)
+        except OSError as e:
+            print('Could not save chunk size: ' + str(e))
+
+    def best(self):
+        if not self.rates:
+            return self.size
+        return max(self.rates, key=self.rates.get)
+
+    def update(self, points, elapsed):
+        # Only full blocks are comparable, the short tail of a record says nothing about the size
+        if self.trials <= 0 or points < self.size or elapsed <= 0:
+            return
+        self.trials -= 1
+        self.rates[self.size] = max(self.rates.get(self.size, 0), 2 * points / elapsed)
+        best = self.best()
+        if self.trials == 0:
+            self.size = best
+            return
+        for candidate in (self.clip(2 * best), self.clip(best // 2)):
+            if candidate not in self.rates:
+                self.size = candidate
+                return
+        self.size = best
+        self.trials = 0
+
+
+def iter_blocks(yk, length, chunk_size, tuner=None, start=0):
+    # Yields (start, int16 block) for every :WAVEFORM:SEND? of the selected trace as it arrives
+    while start < length:
+        if tuner is not None:
+            chunk_size = tuner.size
+        stop = min(length, start + chunk_size)
+        tic = time.perf_counter()
+        block = read_block(yk, start, stop)
+        if tuner is not None:
+            tuner.update(stop - start, time.perf_counter() - tic)
+        yield start, block
+        start = stop
+
+
+def new_timing():
+    # Busy and stall seconds of the two transfer stages. A large process_stall means the link is the bottleneck,
+    # a large io_stall means scaling/storing (the CPU) is.
+    return {'io': 0.0, 'io_stall': 0.0, 'process': 0.0, 'process_stall': 0.0, 'blocks': 0, 'bytes': 0}
+
+
+def timed(blocks, timing):
+    # Synchronous counterpart of prefetch, only accounts the I/O time
+    while True:
+        tic = time.perf_counter()
+        item = next(blocks, None)
+        timing['io'] += time.perf_counter() - tic
+        if item is None:
+            return
+        yield item
+
+
+def prefetch(blocks, depth=4, timing=None):
+    # Runs the blocks generator on a dedicated I/O thread, handing results over through a bounded queue
+    timing = new_timing() if timing is None else timing
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def producer():
+        try:
+            item = None
+            while item is not done and not stop.is_set():
+                tic = time.perf_counter()
+                item = next(blocks, done)
+                timing['io'] += time.perf_counter() - tic
+                tic = time.perf_counter()
+                put(item)
+                timing['io_stall'] += time.perf_counter() - tic
+        except BaseException as e:
+            put(e)
+        finally:
+            blocks.close()
+
+    thread = threading.Thread(target=producer, name='yk-io', daemon=True)
+    thread.start()
+    try:
+        while True:
+            tic = time.perf_counter()
+            item = q.get()
+            timing['process_stall'] += time.perf_counter() - tic
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def read_waveform(yk, length, chunk_size, tuner=None):
+    # Transfers the whole record chunk by chunk into one preallocated int16 buffer
+    out = np.empty(length, dtype=np.int16)
+    with tqdm(total=length) as bar:
+        for start, block in iter_blocks(yk, length, chunk_size, tuner=tuner):
+            out[start:start + len(block)] = block
+            bar.update(len(block))
+    return out
+
+
+# samples per step when deriving products from a record in place
+SPAN = int(1E6)
+
+
+def spans(length, size=SPAN):
+    # (start, stop) of consecutive slices covering range(length)
+    for start in range(0, length, size):
+        yield start, min(length, start + size)
+
+
+def scale_raw(raw, w_range, offset, out=None):
+    # Converts raw counts to volts with ufuncs writing into a single float64 output
+    if out is None:
+        out = np.empty(np.shape(raw), dtype=np.float64)
+    np.multiply(raw, w_range * WORD_SCALE, out=out)
+    out += offset
+    return out
+
+
+class channel_record:
+    # One channel as its int16 counts plus the scaling, sampling rate and amplifier gain: 2 bytes per sample
+    # instead of 8 for every float64 product. volts, acceleration and time are views computed on indexing.
+    def __init__(self, raw, w_range, offset, sampling_rate, amp_gain=1):
+        self.raw = raw
+        self.range = w_range
+        self.offset = offset
+        self.sampling_rate = sampling_rate
+        self.amp_gain = amp_gain
 
+    def __len__(self):
+        return len(self.raw)
 
-def average_reduce(array, factor):
-    if isinstance(array, np.ndarray):
-        array = array.tolist()  # Convert NumPy array to Python list
+    @property
+    def volts(self):
+        return record_view(self, 'volts')
 
-    reduced_array = []
-    i = 0
-    while i < len(array):
-        chunk = array[i:i + factor]
-        if chunk:
-            average = sum(chunk) / len(chunk)
-            reduced_array.append(average)
-        i += factor
-    return reduced_array
+    @property
+    def acceleration(self):
+        return record_view(self, 'acceleration')
+
+    @property
+    def time(self):
+        return record_view(self, 'time')
+
+
+class record_view:
+    # Read-only float64 array-like over a channel_record. Slices and index arrays compute only the samples they
+    # select, np.asarray(view) computes all of them.
+    dtype = np.dtype(np.float64)
+    ndim = 1
+
+    def __init__(self, record, quantity):
+        if quantity not in ('volts', 'acceleration', 'time'):
+            raise ValueError('Unknown record quantity: ' + str(quantity))
+        self.record = record
+        self.quantity = quantity
+
+    def __len__(self):
+        return len(self.record)
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple) and len(index) == 1:
+            index = index[0]
+        record = self.record
+        if self.quantity == 'time':
+            if isinstance(index, slice):
+                samples = np.arange(*index.indices(len(self)))
+            else:
+                samples = np.asarray(index)
+                if samples.dtype == bool:
+                    samples = np.flatnonzero(samples)
+                samples = np.where(samples < 0, samples + len(self), samples)
+            return samples / record.sampling_rate
+        values = scale_raw(record.raw[index], record.range, record.offset)
+        if self.quantity == 'acceleration':
+            values *= 9.81 / 10 / record.amp_gain
+        return values if np.ndim(values) else float(values)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:]
+        return values if dtype is None else values.astype(dtype, copy=False)
 
 
 def damping_func(t, A, l, w, p):
     return A * np.exp(-1 * l * t) * np.cos(w * t - p)
 
 
-def get_devices():
+def get_devices(rm=None):
     try:
-        rm = pyvisa.ResourceManager()
+        rm = rm if rm is not None else pyvisa.ResourceManager()
         resources = rm.list_resources()
         return resources
     except:
         return ['No devices found!']
 
 
+class session_pool:
+    # Process-wide ResourceManager and open resources, kept alive across Streamlit reruns and acquisitions.
+    # Drop-in for acq.rm: open_resource hands out the pooled session, acq gives it back with release().
+    # A session idle for longer than check_interval is checked with *IDN? before use and reopened when the
+    # check fails; a session released after an error is closed and reopened on next use.
+    def __init__(self, rm_factory=None, check_interval=5.0, list_interval=30.0, busy_timeout=60.0):
+        self.rm_factory = rm_factory or pyvisa.ResourceManager
+        self.rm = None
+        self.check_interval = check_interval  # seconds
+        self.list_interval = list_interval  # seconds a resource listing is reused
+        self.busy_timeout = busy_timeout  # seconds to wait for a session in use by another run
+        self.sessions = {}  # name -> {'resource', 'used', 'lock'}
+        self.listing = (None, 0.0)
+        self.lock = threading.Lock()
+
+    def manager(self):
+        if self.rm is None:
+            self.rm = self.rm_factory()
+        return self.rm
+
+    def list_resources(self, refresh=False):
+        resources, listed = self.listing
+        if refresh or resources is None or time.monotonic() - listed > self.list_interval:
+            with self.lock:
+                resources = tuple(self.manager().list_resources())
+            self.listing = (resources, time.monotonic())
+        return resources
+
+    @staticmethod
+    def healthy(resource):
+        try:
+            resource.query('*IDN?')
+            return True
+        except Exception:
+            return False
+
+    def open_resource(self, name, **kwargs):
+        with self.lock:
+            session = self.sessions.setdefault(name, {'resource': None, 'used': 0.0, 'lock': threading.Lock()})
+        if not session['lock'].acquire(timeout=self.busy_timeout):
+            raise TimeoutError(name + ' is in use by another acquisition')
+        try:
+            resource = session['resource']
+            if resource is not None and time.monotonic() - session['used'] > self.check_interval \
+                    and not self.healthy(resource):
+                self.close_session(session)
+                resource = None
+            if resource is None:
+                try:
+                    resource = self.manager().open_resource(name, **kwargs)
+                except Exception:
+                    # the ResourceManager itself may be stale after the instrument was unplugged
+                    self.reset()
+                    resource = self.manager().open_resource(name, **kwargs)
+                session['resource'] = resource
+        except Exception:
+            session['lock'].release()
+            raise
+        return resource
+
+    def release(self, resource, failed=False):
+        for session in self.sessions.values():
+            if session['resource'] is resource:
+                if failed:
+                    self.close_session(session)
+                session['used'] = time.monotonic()
+                session['lock'].release()
+                return
+
+    @staticmethod
+    def close_session(session):
+        try:
+            session['resource'].close()
+        except Exception:
+            pass
+        session['resource'] = None
+
+    def reset(self):
+        # closes every idle session and the ResourceManager
+        with self.lock:
+            for session in self.sessions.values():
+                if session['resource'] is not None and session['lock'].acquire(blocking=False):
+                    self.close_session(session)
+                    session['lock'].release()
+            if self.rm is not None:
+                try:
+                    self.rm.close()
+                except Exception:
+                    pass
+            self.rm = None
+            self.listing = (None, 0.0)
+
+    def close(self):
+        self.reset()
+
+
+def digest(raw):
+    # Content address of a record, hashed span by span so memory-mapped records are not loaded at once
+    h = hashlib.blake2b(digest_size=16)
+    for start, stop in spans(len(raw)):
+        h.update(np.ascontiguousarray(raw[start:stop]).data)
+    return h.hexdigest()
+
+
+def held_bytes(value):
+    # RAM held by the arrays of a cached value, memory-mapped arrays live on disk and are not counted
+    if isinstance(value, np.memmap):
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        value = value.values()
+    if isinstance(value, (tuple, list, type({}.values()))):
+        return sum(held_bytes(item) for item in value)
+    return 0
+
+
+class analysis_cache:
+    # Derived products keyed by (raw digest, scaling, product, parameters), least recently used dropped first
+    # once max_bytes of arrays are held. Shared by acq instances, e.g. across Streamlit reruns.
+    def __init__(self, max_bytes=int(2E9)):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, bytes)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+        value = compute()
+        size = held_bytes(value)
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (value, size)
+                self.size += size
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, (_, dropped) = self.entries.popitem(last=False)
+                self.size -= dropped
+        return value
+
+    def put(self, key, value):
+        self.get(key, lambda: value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+# acq attributes each derived product depends on besides the raw counts and their scaling
+PRODUCT_PARAMS = {
+    't': (),
+    't_volt': (),
+    't_acc': ('amp_gain',),
+    'psd': ('amp_gain', 'psd_seconds', 'psd_window', 'psd_overlap'),
+    'spectrogram': ('amp_gain', 'spectrogram_nperseg', 'spectrogram_frames'),
+    'fit': ('amp_gain', 'refine_fit'),
+    'trace': ('plot_points', 'decimation'),
+    'trace_acc': ('amp_gain', 'plot_points', 'decimation'),
+}
+PRODUCT_PARAMS['psd_pos'] = PRODUCT_PARAMS['psd']
+
+# record_view products: free to rebuild and holding the whole raw record, so never cached
+VIEW_PRODUCTS = ('t', 't_volt', 't_acc')
+
+# products of each plot mode worth computing on the process pool, see acq.precompute
+MODE_PRODUCTS = {
+    'time domain': ('trace',),
+    'frequency domain': ('psd',),
+    'spectrogram': ('spectrogram',),
+    'resonance': ('fit', 'trace_acc'),
+}
+
+# channel_data key -> (product, item of the product's tuple or None for the whole product)
+CHANNEL_KEYS = {
+    't_volt': ('t_volt', None), 't': ('t', None), 't_acc': ('t_acc', None),
+    'f': ('psd', 0), 'psd_acc': ('psd', 1), 'psd_pos': ('psd_pos', None),
+    'spec_f': ('spectrogram', 0), 'spec_t': ('spectrogram', 1), 'spectrogram': ('spectrogram', 2),
+}
+
+# channel_data keys each plot mode reads
+MODE_KEYS = {
+    'time domain': ('t_volt', 't'),
+    'X vs Y': ('t_volt',),
+    'resonance': ('t', 't_acc'),
+    'frequency domain': ('t_acc', 'f', 'psd_acc', 'psd_pos'),
+    'spectrogram': ('spec_f', 'spec_t', 'spectrogram'),
+}
+
+
+SEGMENTS = {}  # id of a record allocated by shared_empty -> name of its shared memory, while the record lives
+
+
+def shared_empty(length, dtype):
+    # Uninitialized record in shared memory, so pool processes attach to it instead of getting a copy. The segment
+    # is unlinked once the record and every view of it are gone.
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, length * dtype.itemsize))
+    array = np.ndarray((length,), dtype, buffer=shm.buf)
+    SEGMENTS[id(array)] = shm.name
+    weakref.finalize(array, release_segment, id(array), shm)
+    return array
+
+
+def release_segment(key, shm):
+    SEGMENTS.pop(key, None)
+    shm.unlink()
+
+
+def share(raw):
+    # (spec, SharedMemory or None) handing a record to pool processes without pickling it: memory-mapped records
+    # are reopened from their file, records from shared_empty are attached by name, others are copied once into
+    # shared memory (closed and unlinked by the caller)
+    if isinstance(raw, np.memmap) and raw.filename:
+        return ('file', raw.filename), None
+    if id(raw) in SEGMENTS:
+        return ('shm', SEGMENTS[id(raw)], raw.shape, raw.dtype.str), None
+    shm = shared_memory.SharedMemory(create=True, size=max(1, raw.nbytes))
+    np.ndarray(raw.shape, raw.dtype, buffer=shm.buf)[:] = raw
+    return ('shm', shm.name, raw.shape, raw.dtype.str), shm
+
+
+def attach(spec):
+    if spec[0] == 'file':
+        return None, np.load(spec[1], mmap_mode='r')
+    shm = shared_memory.SharedMemory(name=spec[1])
+    return shm, np.ndarray(spec[2], np.dtype(spec[3]), buffer=shm.buf)
+
+
+def product_worker(spec, meta, settings, channel, name):
+    # Runs in a pool process: computes one product of a shared record with a private acq and the caller's
+    # settings; the result is a new array/dict that does not reference the shared buffer
+    shm, raw = attach(spec)
+    try:
+        worker = acq()
+        for key, value in settings.items():
+            setattr(worker, key, value)
+        worker.fft_workers = 1  # the pool already keeps every core busy
+        worker.raw = {channel: raw}
+        worker.meta = {channel: meta}
+        value = worker.product(channel, name)
+        del worker, raw
+        return value
+    finally:
+        if shm is not None:
+            shm.close()
+
+
+POOLS = {}  # process pools by size, kept for the life of the process because starting workers is slow
+
+
+def process_pool(workers):
+    # Spawned workers: forking a process that runs other threads (Streamlit, pyvisa, the analysis threads) can
+    # copy a lock held by one of them and deadlock the child
+    if workers not in POOLS:
+        POOLS[workers] = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    return POOLS[workers]
+
+
+class channel_products(MutableMapping):
+    # channel_data entry of one channel: the keys of the selected modes, each computed from the raw counts on
+    # first access and kept, so plots and exports only pay for what they read. Assigned keys are stored as is.
+    def __init__(self, acq, channel, keys):
+        self.acq = acq
+        self.channel = channel
+        self.keys_ = list(keys)
+        self.values_ = {}
+
+    def __getitem__(self, key):
+        if key not in self.values_:
+            if key not in self.keys_:
+                raise KeyError(key)
+            product, item = CHANNEL_KEYS[key]
+            value = self.acq.product(self.channel, product)
+            self.values_[key] = value if item is None else value[item]
+        return self.values_[key]
+
+    def __setitem__(self, key, value):
+        if key not in self.keys_:
+            self.keys_.append(key)
+        self.values_[key] = value
+
+    def __delitem__(self, key):
+        self.keys_.remove(key)
+        self.values_.pop(key, None)
+
+    def __iter__(self):
+        return iter(list(self.keys_))
+
+    def __len__(self):
+        return len(self.keys_)
+
+
 class acq:
     def __init__(self):
         self.prog = {}
         self.chunkSize = int(1E5)
         self.channels = [1]
         self.channel_data = {}
+        self.raw = {}  # int16 counts of the last run, scaled with self.meta
         self.mode = ['time domain']
         self.amp_gain = 1
+        self.meta = {}
+        self.min_record = None  # :WAVeform:RECord? MINimum of the current run, see setup
+        self.pipelined = True  # overlap instrument I/O with scaling and storing of the previous block
+        self.queue_depth = 4
+        self.timing = {}
+        self.progress = None  # callable or queue.Queue receiving progress events, see report
+        self.progress_rate = 5  # events per second at most, phase changes are always published
+        self.reported = 0.0
+        self.started = 0.0
+        self.auto_chunk = False  # tune chunkSize on the link and remember it per resource
+        self.rm = None  # pyvisa.ResourceManager by default, sim.resource_manager for offline runs
+        self.store_dir = None  # write records to memory-mapped .npy files under this directory instead of RAM
+        self.run_name = None  # run subdirectory of store_dir, reuse the name of an interrupted run to resume it
+        self.run_dir = None
+        self.state = {}
+        self.psd_seconds = 1.0  # Welch segment length, None for a single segment over the record (periodogram)
+        self.psd_window = 'hann'
+        self.psd_overlap = 0.5
+        self.spectrogram_nperseg = 1024  # samples per STFT segment, overlapping by half
+        self.spectrogram_frames = 1000  # time bins kept, consecutive segments are averaged beyond that
+        self.fft_workers = -1  # FFT threads of the spectrogram, -1 for all cores
+        self.accumulators = {}  # per channel dsp.welch/dsp.stft fed while the record is transferring
+        self.plot_points = 4000  # samples per trace sent to the browser
+        self.decimation = 'minmax'  # 'minmax', 'lttb' or 'mean', see dsp.decimate
+        self.spectrogram_bins = 512  # frequency rows of the spectrogram heatmap
+        self.refine_fit = False  # repeat the resonance fit on every sample after the decimated fit
+        self.analysis = analysis_cache()  # derived products, pass a shared one to keep them across instances
+        self.processes = os.cpu_count() or 1  # pool size of the post-processing, 1 to compute in this process
+        self.parallel_min_samples = int(1E6)  # smaller captures are processed here, starting workers costs more
 
-    def run(self, instr):
+    def open(self, instr):
+        rm = self.rm if self.rm is not None else pyvisa.ResourceManager()
+        # resources = rm.list_resources()
+        return rm.open_resource(instr)
 
-        flag = True
-        self.channel_data = {}
+    def close(self, yk, failed=False):
+        # pooled sessions stay open for the next run
+        if isinstance(self.rm, session_pool):
+            self.rm.release(yk, failed=failed)
+        else:
+            yk.close()
+
+    def setup(self, yk):
+        yk.write(':COMMunicate:HEADer OFF;:STOP;:WAVeform:FORMat WORD;:WAVeform:BYTEorder LSBFIRST')
+        self.min_record = query_values(yk, [':WAVeform:RECord? MINimum'], int)[0]
+
+    def setup_channel(self, yk, channel):
+        # Selects the channel and reads its scaling, length and sampling rate in one round trip. They are read for
+        # every channel and run: the length of a record stopped before it filled differs from the timebase's.
+        commands = [':WAVeform:TRACE ' + str(channel),
+                    ':WAVeform:RECord ' + str(self.min_record),
+                    ':WAVeform:OFFSet?',
+                    ':WAVeform:RANGe?',
+                    ':WAVeform:LENGth?',
+                    ':WAVeform:SRATe?']
+        offset, w_range, length, sampling_rate = query_values(yk, commands, float, float, int, float)
+        return {'length': length, 'sampling_rate': sampling_rate, 'offset': offset, 'range': w_range}
+
+    def blocks(self, yk, tuner=None):
+        # Raw (channel, start index, int16 block) in transfer order, including the per-channel setup queries
+        for channel in self.channels:
+            meta = self.meta[channel] = self.setup_channel(yk, channel)
+            start = self.resume_point(channel, meta)
+            for start, block in iter_blocks(yk, meta['length'], self.chunkSize, tuner=tuner, start=start):
+                yield channel, start, block
+
+    def open_store(self):
+        # Creates or reopens the run directory and its transfer state
+        self.state = {}
+        self.run_dir = None
+        if self.store_dir is None:
+            return
+        name = self.run_name or datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.run_dir = os.path.join(self.store_dir, name)
+        os.makedirs(self.run_dir, exist_ok=True)
+        try:
+            with open(os.path.join(self.run_dir, 'state.json')) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+
+    def save_state(self):
+        if self.run_dir is None:
+            return
+        for raw in self.raw.values():
+            if isinstance(raw, np.memmap):
+                raw.flush()
+        path = os.path.join(self.run_dir, 'state.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def resume_point(self, channel, meta):
+        # Samples of the channel already on disk from an interrupted run of the same record
+        saved = self.state.get(str(channel))
+        if saved is None:
+            return 0
+        if any(saved[key] != meta[key] for key in ('length', 'sampling_rate', 'range', 'offset')):
+            print('Channel {} settings changed since the interrupted run, transferring again'.format(channel))
+            return 0
+        return saved['done']
+
+    def array(self, channel, name, length, dtype=np.float64):
+        # Output array of a channel product: in RAM (raw counts in shared memory when a process pool may read
+        # them), or a .npy memmap in the run directory
+        if self.run_dir is None:
+            if name == 'raw' and self.processes > 1:
+                return shared_empty(length, dtype)
+            return np.empty(length, dtype=dtype)
+        path = os.path.join(self.run_dir, 'C{}_{}.npy'.format(channel, name))
+        if os.path.exists(path):
+            array = np.load(path, mmap_mode='r+')
+            if array.shape == (length,) and array.dtype == dtype:
+                return array
+            del array
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(length,))
+
+    def report(self, phase, channel=None, force=False, **extra):
+        # Publishes {'phase', 'channel', 'iteration', 'channels', 'prog', 'bytes', 'blocks', 'rate', 'eta',
+        # 'elapsed'} to self.progress, throttled to progress_rate. phase is 'setup', 'transfer', 'process',
+        # 'done' or 'error'; rate is in bytes/s, eta in seconds of transfer left (None until known).
+        if self.progress is None:
+            return
+        now = time.perf_counter()
+        if not force and now - self.reported < 1 / self.progress_rate:
+            return
+        self.reported = now
+        elapsed = now - self.started
+        transferred = self.timing.get('bytes', 0)
+        rate = transferred / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.meta and rate > 0:
+            # rest of the current channel, channels not reached yet are assumed as long as the last one seen
+            length = list(self.meta.values())[-1]['length']
+            left = len(self.channels) - self.prog.get('iteration', 1)
+            eta = max(0.0, 2 * length * (1 - self.prog.get('prog', 0) + left) / rate)
+        event = dict(phase=phase, channel=channel, iteration=self.prog.get('iteration', 0),
+                     channels=len(self.channels), prog=self.prog.get('prog', 0), bytes=transferred,
+                     blocks=self.timing.get('blocks', 0), rate=rate, eta=eta, elapsed=elapsed, **extra)
+        if hasattr(self.progress, 'put'):
+            self.progress.put(event)
+        else:
+            self.progress(event)
+
+    def stream(self, instr, raw=False):
+        # Yields (channel, start index, volts) for every block as it arrives, or the int16 counts with raw=True.
+        # Record length, sampling rate and scaling of a channel are in self.meta[channel] from its first chunk on.
+        # With self.pipelined the instrument I/O runs on its own thread, self.queue_depth blocks ahead.
+        self.meta = {}
+        self.timing = new_timing()
         self.prog = {
             'iteration': 1,
             'prog': 0
         }
+        self.started = time.perf_counter()
+        self.report('setup', force=True)
+
+        yk = self.open(instr)
+        tuner = chunk_tuner(instr, self.chunkSize) if self.auto_chunk else None
+        bar = None
+        blocks = None
+        failed = False
+        try:
+            self.setup(yk)
+            blocks = self.blocks(yk, tuner=tuner)
+            if self.pipelined:
+                blocks = prefetch(blocks, depth=self.queue_depth, timing=self.timing)
+            else:
+                blocks = timed(blocks, self.timing)
+            current = None
+            for channel, start, block in blocks:
+                tic = time.perf_counter()
+                meta = self.meta[channel]
+                if channel != current:
+                    if bar is not None:
+                        bar.close()
+                        print('Channel completed')
+                    current = channel
+                    bar = tqdm(total=meta['length'])
+                    self.prog['iteration'] = self.channels.index(channel) + 1
+                    self.prog['prog'] = start / meta['length']
+                    self.report('transfer', channel, force=True)
+                volts = block if raw else scale_raw(block, meta['range'], meta['offset'])
+                self.timing['blocks'] += 1
+                self.timing['bytes'] += block.nbytes
+                yield channel, start, volts
+                bar.update(len(block))
+                self.prog['prog'] = (start + len(block)) / meta['length']
+                self.report('transfer', channel)
+                self.timing['process'] += time.perf_counter() - tic
+            if bar is not None:
+                print('Channel completed')
+            self.prog['iteration'] = len(self.channels) + 1
+            if tuner is not None:
+                self.chunkSize = tuner.best()
+                tuner.save()
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if bar is not None:
+                bar.close()
+            if blocks is not None:
+                blocks.close()
+            self.close(yk, failed=failed)
+
+    def record(self, channel):
+        meta = self.meta[channel]
+        return channel_record(self.raw[channel], meta['range'], meta['offset'], meta['sampling_rate'],
+                              self.amp_gain)
+
+    def acceleration(self, channel, start, stop):
+        return self.record(channel).acceleration[start:stop]
+
+    def new_psd(self, channel):
+        meta = self.meta[channel]
+        if self.psd_seconds is None:
+            return dsp.welch(meta['sampling_rate'], max(1, meta['length']), window='boxcar', noverlap=0)
+        nperseg = max(1, min(meta['length'], int(self.psd_seconds * meta['sampling_rate'])))
+        return dsp.welch(meta['sampling_rate'], nperseg, window=self.psd_window,
+                         noverlap=int(self.psd_overlap * nperseg))
+
+    def new_spectrogram(self, channel):
+        meta = self.meta[channel]
+        nperseg = max(1, min(meta['length'], self.spectrogram_nperseg))
+        return dsp.stft(meta['sampling_rate'], nperseg, length=meta['length'], max_frames=self.spectrogram_frames,
+                        workers=self.fft_workers)
+
+    def new_accumulators(self, channel):
+        accumulators = {}
+        if 'frequency domain' in self.mode:
+            accumulators['psd'] = self.new_psd(channel)
+        if 'spectrogram' in self.mode:
+            accumulators['spectrogram'] = self.new_spectrogram(channel)
+        for name, accumulator in accumulators.items():
+            accumulator.params = self.params(name)
+        return accumulators
+
+    def accumulated(self, channel, name):
+        # Accumulator fed during the transfer, rebuilt from the counts if blocks were missed (resume) or the
+        # parameters changed since
+        accumulator = self.accumulators.get(channel, {}).get(name)
+        if not self.accumulator_valid(channel, name):
+            length = len(self.raw[channel])
+            accumulator = {'psd': self.new_psd, 'spectrogram': self.new_spectrogram}[name](channel)
+            for start, stop in spans(length):
+                accumulator.update(self.acceleration(channel, start, stop))
+            accumulator.params = self.params(name)
+            self.accumulators.setdefault(channel, {})[name] = accumulator
+        return accumulator
+
+    def accumulator_valid(self, channel, name):
+        accumulator = self.accumulators.get(channel, {}).get(name)
+        return accumulator is not None and accumulator.samples == len(self.raw[channel]) and \
+            accumulator.params == self.params(name)
+
+    def params(self, name):
+        return tuple(getattr(self, param) for param in PRODUCT_PARAMS[name])
+
+    def key(self, channel, name):
+        meta = self.meta[channel]
+        if 'digest' not in meta:
+            meta['digest'] = digest(self.raw[channel])
+        return (meta['digest'], meta['range'], meta['offset'], meta['sampling_rate'], name) + self.params(name)
+
+    def product(self, channel, name):
+        # Derived product of a channel, computed from the raw counts only if the analysis cache misses
+        if name in VIEW_PRODUCTS:
+            return getattr(self, 'compute_' + name)(channel)
+        return self.analysis.get(self.key(channel, name), lambda: getattr(self, 'compute_' + name)(channel))
+
+    def precompute(self):
+        # Computes the heavy products of the selected modes for all channels at once on a process pool, one task
+        # per channel and product, and puts them in the analysis cache where channel_products finds them.
+        # Records reach the workers through shared memory (or their .npy file), only results are pickled.
+        # Products already cached or fed during the transfer are skipped; small captures stay lazy.
+        names = dict.fromkeys(name for mode in self.mode for name in MODE_PRODUCTS.get(mode, ()))
+        tasks = [(channel, name) for channel in self.channels for name in names
+                 if self.key(channel, name) not in self.analysis and
+                 not (name in ('psd', 'spectrogram') and self.accumulator_valid(channel, name))]
+        samples = sum(len(self.raw[channel]) for channel in {channel for channel, _ in tasks})
+        if self.processes < 2 or len(tasks) < 2 or samples < self.parallel_min_samples:
+            return
+        settings = {param: getattr(self, param) for params in PRODUCT_PARAMS.values() for param in params}
+        shared = {}
+        try:
+            for channel in dict.fromkeys(channel for channel, _ in tasks):
+                shared[channel] = share(self.raw[channel])
+            pool = process_pool(self.processes)
+            futures = {pool.submit(product_worker, shared[channel][0], self.meta[channel], settings, channel,
+                                   name): (channel, name) for channel, name in tasks}
+            for future in as_completed(futures):
+                channel, name = futures[future]
+                error = future.exception()
+                if isinstance(error, BrokenProcessPool):
+                    raise error
+                if error is not None:
+                    # e.g. a resonance fit that does not converge: the product stays lazy and fails when read,
+                    # as it does without the pool, while the acquisition and the other products are kept
+                    print('Channel {} {} failed: {!r}'.format(channel, name, error))
+                    continue
+                self.analysis.put(self.key(channel, name), future.result())
+                self.report('process', channel)
+        except BrokenProcessPool:
+            # a worker died (out of memory?): drop the pool, the products are computed here when read
+            POOLS.pop(self.processes, None)
+        finally:
+            for _, shm in shared.values():
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+
+    def compute_t(self, channel):
+        return self.record(channel).time
+
+    def compute_t_volt(self, channel):
+        return self.record(channel).volts
+
+    def compute_t_acc(self, channel):
+        return self.record(channel).acceleration
+
+    def compute_psd(self, channel):
+        freq, psd_acc = self.accumulated(channel, 'psd').result()
+        return freq[1:-1], psd_acc[1:-1]
+
+    def compute_trace(self, channel):
+        return dsp.decimate(self.product(channel, 't'), self.product(channel, 't_volt'), self.plot_points,
+                            self.decimation)
+
+    def compute_trace_acc(self, channel):
+        return dsp.decimate(self.product(channel, 't'), self.product(channel, 't_acc'), self.plot_points,
+                            self.decimation)
+
+    def compute_psd_pos(self, channel):
+        freq, psd_acc = self.product(channel, 'psd')
+        return psd_acc / freq ** 2
+
+    def compute_spectrogram(self, channel):
+        return self.accumulated(channel, 'spectrogram').result()
+
+    def compute_fit(self, channel):
+        return dsp.fit_resonance(self.product(channel, 't'), self.product(channel, 't_acc'),
+                                 self.meta[channel]['sampling_rate'], refine=self.refine_fit)
+
+    async def run_async(self, instr):
+        # run() as an awaitable, so other instruments can be driven meanwhile, e.g.
+        #   await asyncio.gather(acq.run_async(instr), generator.write('OUTPut ON'))
+        # The transfer stays the blocking run() on a worker thread, not aio.instrument calls: it owns its session
+        # and already overlaps the link with processing through prefetch.
+        return await aio.run(self.run, instr)
+
+    def run(self, instr):
+        try:
+            self.acquire(instr)
+        except Exception as error:
+            self.report('error', force=True, error=str(error))
+            raise
+        self.report('done', force=True)
+
+    def acquire(self, instr):
+        self.channel_data = {}
+        self.raw = {}
+        self.accumulators = {}
         for channel in self.channels:
             self.channel_data[channel] = None
 
-        rm = pyvisa.ResourceManager()
-        # resources = rm.list_resources()
-        yk = rm.open_resource(instr)
+        self.open_store()
+        saved = time.perf_counter()
+        try:
+            for channel, start, block in self.stream(instr, raw=True):
+                meta = self.meta[channel]
+                if channel not in self.raw:
+                    self.raw[channel] = self.array(channel, 'raw', meta['length'], np.int16)
+                self.raw[channel][start:start + len(block)] = block
+                if start == 0:
+                    self.accumulators[channel] = self.new_accumulators(channel)
+                if self.accumulators.get(channel):
+                    acceleration = self.acceleration(channel, start, start + len(block))
+                    for accumulator in self.accumulators[channel].values():
+                        accumulator.update(acceleration)
+                if self.run_dir is not None:
+                    self.state[str(channel)] = dict(meta, done=start + len(block))
+                    if time.perf_counter() - saved > 1:
+                        self.save_state()
+                        saved = time.perf_counter()
+        finally:
+            self.save_state()
 
-        yk.write(':STOP')
-        yk.write(':WAVEFORM:FORMAT WORD')
-        yk.write(':WAVEFORM:BYTEORDER LSBFIRST')
-        yk.write(':WAVeform:FORMat WORD')
+        for channel in self.channels:
+            meta = self.meta[channel]
+            if channel not in self.raw:
+                self.raw[channel] = self.array(channel, 'raw', meta['length'], np.int16)
+        self.analyse()
 
+    def analyse(self):
+        # channel_data from the raw counts in hand (self.raw, self.meta) for the current mode and gain, without
+        # touching the instrument. Products are computed when first read, or come from self.analysis when they
+        # were computed before with the same parameters.
+        self.channel_data = {}
         for channel in self.channels:
-            if flag:
-                yk.write(':WAVeform:TRACE ' + str(channel))
-                result = yk.query('WAVEFORM:RECord? MINimum')
-                min_record = int(extract_number(result))
-                yk.write(':WAVeform:RECord ' + str(min_record))
-                result = yk.query(':WAVEFORM:LENGth?')
-                length = int(extract_number(result))
-                result = yk.query(':WAVeform:SRATe?')  # Get sampling rate
-                sampling_rate = extract_number(result)
-
-            if flag:
-
-                data = {}
-
-                n = int(np.floor(length / self.chunkSize))
-                t_data = []
-
-                for i in tqdm(range(n + 1)):
-                    m = min(length, (i + 1) * self.chunkSize) - 1
-
-                    yk.write(":WAVEFORM:START {};:WAVEFORM:END {}".format(i * self.chunkSize, m))
-                    buff = yk.query_binary_values(':WAVEFORM:SEND?', datatype='h', container=list)
-
-                    t_data.extend(buff)
-                    self.prog['prog'] = (i + 1) / (n + 1)
-
-                result = yk.query(':WAVEFORM:OFFSET?')
-                offset = extract_number(result)
-
-                result = yk.query(':WAVeform:RANGe?')
-                w_range = extract_number(result)
-
-                t_data = w_range * np.array(
-                    t_data) * 10 / 24000 + offset  # some random bullshit formula in the communication manual
-
-                if 'time domain' or 'X vs Y' or 'resonance' in self.mode:
-                    data['t_volt'] = t_data
-                    if 'time domain' or 'resonance' in self.mode:
-                        data['t'] = np.arange(len(t_data)) / sampling_rate
-
-                if 'frequency domain' or 'resonance' in self.mode:
-                    data['t_acc'] = (9.81 / 10) * t_data / self.amp_gain
-                    if 'frequency domain' in self.mode:
-                        freq, psd_acc = sc.signal.periodogram(data['t_acc'], fs=sampling_rate)
-                            # sc.signal.welch(data['t_acc'],fs=sampling_rate,nperseg=sampling_rate,window='blackman',noverlap=0)
-                        freq = freq[1:-1]
-                        psd_acc = psd_acc[1:-1]
-
-                        data['f'] = freq
-                        data['psd_acc'] = psd_acc
-                        data['psd_pos'] = psd_acc / freq ** 2
-                self.channel_data[channel] = data
-            self.prog['iteration'] += 1
-            print('Channel completed')
-        yk.close()
+            self.report('process', channel, force=True)
+            self.channel_data[channel] = self.derive(channel)
+        self.precompute()
+        return self.channel_data
+
+    def derive(self, channel):
+        # Products of the selected modes, computed when first read. The time-domain ones are views of the raw
+        # counts (record_view), the rest are computed span by span from them.
+        keys = [key for key in CHANNEL_KEYS if any(key in MODE_KEYS.get(mode, ()) for mode in self.mode)]
+        return channel_products(self, channel, keys)
 
     def plot(self):
         figs = []
         if 'time domain' in self.mode:
             for i, (key, data) in enumerate(self.channel_data.items()):
                 # Time Domain Plot
-                t = data['t']
-                t_data = data['t_volt']
+                t, t_data = self.product(key, 'trace')
                 fig = go.Figure(data=go.Scatter(
                     x=t,
                     y=t_data,
@@ -163,6 +1049,12 @@ class acq:
                 y_lim.append(1E1 * np.max(psd_data[0:i_xlim]))
                 log_y_lim = [math.log10(bound) for bound in y_lim]
 
+                # the initially visible range and the rest get a point budget each, so zooming out still works
+                i_view = np.searchsorted(f, x_lim[1], side='right')
+                f_view, psd_view = dsp.decimate(f[:i_view], psd_data[:i_view], self.plot_points, self.decimation)
+                f_rest, psd_rest = dsp.decimate(f[i_view:], psd_data[i_view:], self.plot_points, self.decimation)
+                f = np.concatenate((f_view, f_rest))
+                psd_data = np.concatenate((psd_view, psd_rest))
                 fig = go.Figure(data=go.Scatter(
                     x=f,
                     y=psd_data,
@@ -177,16 +1069,34 @@ class acq:
                 fig.update_yaxes(type="log")
                 figs.append(fig)
 
+        if 'spectrogram' in self.mode:
+            for i, (key, data) in enumerate(self.channel_data.items()):
+                # Spectrogram, frequency bins averaged down to the plot budget (time bins are already bounded)
+                f, spectrogram = dsp.reduce_columns(data['spec_f'], data['spectrogram'], self.spectrogram_bins)
+                with np.errstate(divide='ignore'):
+                    z = 10 * np.log10(spectrogram.T)
+                fig = go.Figure(data=go.Heatmap(
+                    x=data['spec_t'],
+                    y=f,
+                    z=z,
+                    colorbar={'title': 'dB'}))
+                fig.update_layout(
+                    title_text='Spectrogram, Channel ' + str(key),
+                    xaxis_title='Time (s)',
+                    yaxis_title='Frequency (Hz)')
+                figs.append(fig)
+
         if 'resonance' in self.mode:
             for i, (key, data) in enumerate(self.channel_data.items()):
                 # Time Domain Plot
-                t = data['t']
-                t_data = data['t_acc']
-                popt, pcov = sc.optimize.curve_fit(damping_func, t, t_data)
-                [A, l, w, p] = popt
+                fit = self.product(key, 'fit')
+                [A, l, w, p] = fit['popt']
+                [sA, sl, sw, sp] = fit['perr']
                 fn = w / (2 * math.pi)
                 zeta = l / np.sqrt(l ** 2 + w ** 2)
                 delta = 2 * 3.1416 * zeta / np.sqrt(1 - zeta ** 2)
+                data['fit'] = np.concatenate((fit['popt'], fit['perr']))
+                t, t_data = self.product(key, 'trace_acc')
                 t_fit = damping_func(t, A, l, w, p)
                 data_trace = go.Scatter(
                     x=t,
@@ -199,7 +1109,9 @@ class acq:
                 fig = go.Figure(data=[data_trace, fit_trace])
                 titlestring = 'Resonance Measurement of QZS Flexure Component, Channel ' + str(key) + '<br>'
                 #titlestring += r'fit to $y = A \exp{-\lambda t} \cos{\omega t - \varphi}$' + '<br>'
-                titlestring += r"A={:.5g}, l={:.5g}, w={:.5g}, fn={:.5g} p={:.5g}, d={:.5g}".format(A, l, w, fn, p, delta)
+                titlestring += r"A={:.5g}±{:.2g}, l={:.5g}±{:.2g}, w={:.5g}±{:.2g}, fn={:.5g} p={:.5g}±{:.2g}, d={:.5g}".format(
+                    A, sA, l, sl, w, sw, fn, p, sp, delta)
+                titlestring += '<br>fit on {} points in {:.3g} s'.format(fit['points'], sum(fit['timing'].values()))
                 fig.update_layout(
                     title_text=titlestring,
                     xaxis_title='Time (s)',
@@ -215,8 +1127,8 @@ class acq:
             self.channel_data[self.channels[1]]['force (N)'] = y
             self.channel_data[self.channels[1]]['distance (mm)'] = []
 
-            x_reduced = average_reduce(x, 100)
-            y_reduced = average_reduce(y, 100)
+            # parametric curve, both axes are averaged over the same bins
+            x_reduced, y_reduced = dsp.decimate(x, y, self.plot_points, 'mean')
             fig = go.Figure(data=go.Scatter(
                 x=x_reduced,
                 y=y_reduced,